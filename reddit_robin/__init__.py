@@ -30,6 +30,7 @@ class Robin(Plugin):
         ),
 
         "robin-join": Module("robin-join.js",
+            "websocket.js",
             "robin/join.js",
         ),
     }
@@ -37,6 +38,9 @@ class Robin(Plugin):
     live_config = {
         ConfigValue.int: [
             "robin_ratelimit_window",
+            "robin_reaper_workers",
+            "robin_matchmaker_slots",
+            "robin_chat_batch_min_level",
         ],
 
         ConfigValue.dict(ConfigValue.int, ConfigValue.float): [
@@ -49,13 +53,17 @@ class Robin(Plugin):
 
         queues.declare({
             "robin_presence_q": MessageQueue(),
+            "robin_vote_q": MessageQueue(bind_to_self=True),
+            "robin_chat_q": MessageQueue(bind_to_self=True),
             "robin_waitinglist_q": MessageQueue(bind_to_self=True),
             "robin_subreddit_maker_q": MessageQueue(bind_to_self=True),
+            "robin_subreddit_members_q": MessageQueue(bind_to_self=True),
         })
 
         queues.robin_presence_q << (
             "websocket.connect",
             "websocket.disconnect",
+            "robin.heartbeat",
         )
 
     def add_routes(self, mc):
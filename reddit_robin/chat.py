@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import json
+
+from pylons import app_globals as g
+
+from r2.lib import amqp, websockets
+
+
+# Messages for rooms at or above the robin_chat_batch_min_level live_config
+# level are queued and sent as one chat_batch broadcast per room per batch
+# rather than one broadcast each.
+CHAT_BATCH_SIZE = 500
+
+# How long to wait for more messages to build up when the queue is empty.
+CHAT_BATCH_INTERVAL = 0.05
+
+
+def should_batch_chat(room):
+    min_level = g.live_config.get("robin_chat_batch_min_level")
+    return min_level is not None and room.level >= min_level
+
+
+def queue_chat_message(room, user, body):
+    payload = {
+        "room_id": room.id,
+        "from": user.name,
+        "body": body,
+    }
+    amqp.add_item("robin_chat_q", json.dumps(payload))
+
+
+def run():
+    @g.stats.amqp_processor("robin_chat_q")
+    def process_chat_messages(msgs, chan):
+        messages_by_room_id = OrderedDict()
+        for msg in msgs:
+            payload = json.loads(msg.body)
+            messages = messages_by_room_id.setdefault(payload["room_id"], [])
+            messages.append({
+                "from": payload["from"],
+                "body": payload["body"],
+            })
+
+        for room_id, messages in messages_by_room_id.iteritems():
+            websockets.send_broadcast(
+                namespace="/robin/" + room_id,
+                type="chat_batch",
+                payload={"messages": messages},
+            )
+
+    amqp.handle_items(
+        "robin_chat_q",
+        process_chat_messages,
+        limit=CHAT_BATCH_SIZE,
+        sleep_time=CHAT_BATCH_INTERVAL,
+        verbose=False,
+    )
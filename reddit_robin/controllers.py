@@ -1,3 +1,4 @@
+import bisect
 import datetime
 import posixpath
 
@@ -20,13 +21,13 @@ from r2.lib.validator import (
     VAccountByName,
     VAdmin,
     VBoolean,
+    VInt,
     VLength,
     VModhash,
     VNotInTimeout,
     VOneOf,
     VUser,
 )
-from r2.models import Account
 
 from . import events
 from .validators import VRobinRoom
@@ -38,9 +39,59 @@ from .pages import (
     RobinJoin,
     RobinChat,
 )
+from .chat import queue_chat_message, should_batch_chat
 from .models import RobinRoom, VALID_VOTES
 from .matchmaker import add_to_waitinglist
+from .presence import queue_heartbeat
 from .reaper import prompt_for_voting, reap_ripe_rooms, get_reap_time
+from .votes import queue_vote
+
+
+_ratelimit_table = {
+    "config": None,
+    "levels": [],
+    "avg_per_sec": [],
+}
+
+# Users this process has seen go over the shared ratelimit in the current
+# window. They're rejected without a memcache hit for the rest of it, since
+# usage can only go up until the window ends.
+_over_ratelimit = {
+    "time_slice": None,
+    "keys": set(),
+}
+
+
+def _get_ratelimit_avg_per_sec(level):
+    """Return the ratelimit (as average events per second) for a room level.
+
+    This uses the highest level configured that's not bigger than the room.
+    e.g. if ratelimits are defined for levels 1, 2, and 4 and the room is
+    level 3, this will give us the ratelimit specified for 2.
+
+    """
+
+    by_level = g.live_config.get("robin_ratelimit_avg_per_sec", {})
+    if by_level is not _ratelimit_table["config"]:
+        # live_config hands out a new dict when it's reloaded, so only sort
+        # the levels when that happens
+        items = sorted((int(config_level), avg_per_sec)
+                       for config_level, avg_per_sec in by_level.iteritems())
+        _ratelimit_table["levels"] = [item[0] for item in items]
+        _ratelimit_table["avg_per_sec"] = [item[1] for item in items]
+        _ratelimit_table["config"] = by_level
+
+    index = bisect.bisect_right(_ratelimit_table["levels"], level) - 1
+    if index < 0:
+        return 1
+    return _ratelimit_table["avg_per_sec"][index]
+
+
+def _get_over_ratelimit(time_slice):
+    if _over_ratelimit["time_slice"] != time_slice.beginning:
+        _over_ratelimit["time_slice"] = time_slice.beginning
+        _over_ratelimit["keys"] = set()
+    return _over_ratelimit["keys"]
 
 
 @add_controller
@@ -55,23 +106,32 @@ class RobinController(RedditController):
         VNotInTimeout(),
     )
     def GET_join(self):
-        room = RobinRoom.get_room_for_user(c.user)
-        if room:
+        room_id = RobinRoom.get_room_id_for_user(c.user)
+        if room_id:
             return self.redirect("/robin")
 
+        # the matchmaker will tell us about our room assignment over this
+        # websocket so we don't have to keep polling for it
+        path = posixpath.join("/robin-join", c.user._id36)
+        websocket_url = websockets.make_url(path, max_age=3600)
+
         return RobinPage(
             title="robin",
             content=RobinJoin(robin_heavy_load=g.live_config.get(
                 'robin_heavy_load')),
+            extra_js_config={
+                "robin_join_websocket_url": websocket_url,
+            },
         ).render()
 
     @validate(
         VAdmin(),
+        page=VInt("page", min=1, num_default=1),
     )
-    def GET_all(self):
+    def GET_all(self, page):
         return RobinPage(
             title="robin",
-            content=RobinAll(),
+            content=RobinAll(page=page),
         ).render()
 
     @validate(
@@ -118,31 +178,14 @@ class RobinController(RedditController):
         path = posixpath.join("/robin", room.id, c.user._id36)
         websocket_url = websockets.make_url(path, max_age=3600)
 
-        all_user_ids = room.get_all_participants()
-        all_present_ids = room.get_present_participants()
-        all_votes = room.get_all_votes()
-
-        users = Account._byID(all_user_ids, data=True, stale=True)
-        user_list = []
-
-        for user in users.itervalues():
-            if user._id in all_votes:
-                vote = all_votes.get(user._id)
-            else:
-                vote = None
-
-            user_list.append({
-                "name": user.name,
-                "present": user._id in all_present_ids,
-                "vote": vote,
-            });
+        room_name, user_list = room.get_snapshot()
 
         return RobinChatPage(
-            title="chat in %s" % room.name,
+            title="chat in %s" % room_name,
             content=RobinChat(room=room),
             extra_js_config={
                 "robin_room_is_continued": room.is_continued,
-                "robin_room_name": room.name,
+                "robin_room_name": room_name,
                 "robin_room_id": room.id,
                 "robin_websocket_url": websocket_url,
                 "robin_user_list": user_list,
@@ -152,46 +195,42 @@ class RobinController(RedditController):
         ).render()
 
     def _has_exceeded_ratelimit(self, form, room):
-        # grab the ratelimit (as average events per second) for the room's
-        # current level, using the highest level configured that's not bigger
-        # than the room.  e.g. if ratelimits are defined for levels 1, 2, and 4
-        # and the room is level 3, this will give us the ratelimit specified
-        # for 2.
-        desired_avg_per_sec = 1
-        by_level = g.live_config.get("robin_ratelimit_avg_per_sec", {})
-        for level, avg_per_sec in sorted(by_level.items(), key=lambda (x,y): int(x)):
-            if int(level) > room.level:
-                break
-            desired_avg_per_sec = avg_per_sec
+        desired_avg_per_sec = _get_ratelimit_avg_per_sec(room.level)
 
         # now figure out how many events per window that means
         window_size = g.live_config.get("robin_ratelimit_window", 10)
         allowed_events_per_window = int(desired_avg_per_sec * window_size)
 
-        try:
-            # now figure out how much they've actually used
-            ratelimit_key = "robin/{}".format(c.user._id36)
-            time_slice = ratelimit.get_timeslice(window_size)
-            usage = ratelimit.get_usage(ratelimit_key, time_slice)
+        ratelimit_key = "robin/{}".format(c.user._id36)
+        time_slice = ratelimit.get_timeslice(window_size)
+        over_ratelimit = _get_over_ratelimit(time_slice)
+
+        if ratelimit_key not in over_ratelimit:
+            try:
+                # record the usage and get the shared total back. this is an
+                # add and an incr, so two memcache operations, and it counts
+                # the request that first goes over the limit too
+                usage = ratelimit.record_usage(ratelimit_key, time_slice)
+            except ratelimit.RatelimitError as exc:
+                g.log.warning("ratelimit error: %s", exc)
+                return False
 
-            # ratelimit them if too much
-            if usage >= allowed_events_per_window:
-                g.stats.simple_event("robin.ratelimit.exceeded")
+            if usage <= allowed_events_per_window:
+                return False
 
-                period_end = datetime.datetime.utcfromtimestamp(time_slice.end)
-                period_end_utc = period_end.replace(tzinfo=pytz.UTC)
-                until_reset = utils.timeuntil(period_end_utc)
-                c.errors.add(errors.RATELIMIT, {"time": until_reset},
-                             field="ratelimit", code=429)
-                form.has_errors("ratelimit", errors.RATELIMIT)
+            over_ratelimit.add(ratelimit_key)
 
-                return True
+        # ratelimit them if too much
+        g.stats.simple_event("robin.ratelimit.exceeded")
 
-            # or record the usage and move on
-            ratelimit.record_usage(ratelimit_key, time_slice)
-        except ratelimit.RatelimitError as exc:
-            g.log.warning("ratelimit error: %s", exc)
-        return False
+        period_end = datetime.datetime.utcfromtimestamp(time_slice.end)
+        period_end_utc = period_end.replace(tzinfo=pytz.UTC)
+        until_reset = utils.timeuntil(period_end_utc)
+        c.errors.add(errors.RATELIMIT, {"time": until_reset},
+                     field="ratelimit", code=429)
+        form.has_errors("ratelimit", errors.RATELIMIT)
+
+        return True
 
     @validatedForm(
         VUser(),
@@ -207,14 +246,17 @@ class RobinController(RedditController):
         if form.has_errors("message", errors.NO_TEXT, errors.TOO_LONG):
             return
 
-        websockets.send_broadcast(
-            namespace="/robin/" + room.id,
-            type="chat",
-            payload={
-                "from": c.user.name,
-                "body": message,
-            },
-        )
+        if should_batch_chat(room):
+            queue_chat_message(room, c.user, message)
+        else:
+            websockets.send_broadcast(
+                namespace="/robin/" + room.id,
+                type="chat",
+                payload={
+                    "from": c.user.name,
+                    "body": message,
+                },
+            )
 
         events.message(
             room=room,
@@ -225,6 +267,22 @@ class RobinController(RedditController):
         )
 
 
+    @validatedForm(
+        VUser(),
+        VModhash(),
+        room=VRobinRoom("room_id"),
+    )
+    def POST_heartbeat(self, form, jquery, room):
+        """Keep the user marked as present in the room.
+
+        The websocket service only tells us about connects and disconnects,
+        so connected clients call this periodically to refresh their presence
+        before it expires.
+
+        """
+
+        queue_heartbeat(room, c.user)
+
     @validatedForm(
         VUser(),
         VNotInTimeout(),
@@ -242,15 +300,7 @@ class RobinController(RedditController):
 
         g.stats.simple_event('robin.vote.%s' % vote)
 
-        room.set_vote(c.user, vote)
-        websockets.send_broadcast(
-            namespace="/robin/" + room.id,
-            type="vote",
-            payload={
-                "from": c.user.name,
-                "vote": vote,
-            },
-        )
+        queue_vote(room, c.user, vote)
 
         events.vote(
             room=room,
@@ -271,8 +321,8 @@ class RobinController(RedditController):
                 "Robin is currently experience high load.")
             abort(503)
 
-        room = RobinRoom.get_room_for_user(c.user)
-        if room:
+        room_id = RobinRoom.get_room_id_for_user(c.user)
+        if room_id:
             # user is already in a room, they should get redirected by the
             # frontend after polling /api/room_assignment.json
             return
@@ -301,9 +351,9 @@ class RobinController(RedditController):
         VNotInTimeout(),
     )
     def GET_room_assignment(self, responder):
-        room = RobinRoom.get_room_for_user(c.user)
-        if room:
-            return {"roomId": room.id}
+        room_id = RobinRoom.get_room_id_for_user(c.user)
+        if room_id:
+            return {"roomId": room_id}
 
     @validatedForm(
         VAdmin(),
@@ -1,20 +1,88 @@
-from datetime import datetime
+import Queue
+import threading
 
+import pytz
 from pylons import app_globals as g
 
 from r2.lib.eventcollector import Event
 
 EVENT_TOPIC = "robin_events"
 
+# Events are handed off to a background thread that saves them in batches so
+# they don't add to request latency. If the queue is full the event is
+# dropped rather than blocking the request.
+EVENT_QUEUE_SIZE = 10000
+EVENT_BATCH_SIZE = 100
 
-def _age_in_ms(room):
-    age = datetime.now(g.tz) - room.date
-    age_in_ms = (age.seconds * 1000) + (age.microseconds / 1000)
+_event_queue = Queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+_flush_thread_lock = threading.Lock()
+_flush_thread = []
+
+
+def _age_in_ms(room_date, sent_dt):
+    age = sent_dt.replace(tzinfo=pytz.UTC) - room_date
+    age_in_ms = (age.days * 86400000 + age.seconds * 1000 +
+                 age.microseconds / 1000)
     return age_in_ms
 
 
+def _flush_events(app_globals):
+    g._push_object(app_globals)
+    try:
+        while True:
+            batch = [_event_queue.get()]
+            while len(batch) < EVENT_BATCH_SIZE:
+                try:
+                    batch.append(_event_queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for event, room_date, sent_dt in batch:
+                event.add("room_age", _age_in_ms(room_date, sent_dt))
+                try:
+                    g.events.save_event(event)
+                except Exception as exc:
+                    g.log.warning("robin event save failed: %s", exc)
+    finally:
+        g._pop_object(app_globals)
+
+
+def _ensure_flush_thread():
+    if _flush_thread:
+        return
+
+    with _flush_thread_lock:
+        if _flush_thread:
+            return
+
+        thread = threading.Thread(
+            target=_flush_events,
+            args=(g._current_obj(),),
+            name="robin_events",
+        )
+        thread.daemon = True
+        thread.start()
+        _flush_thread.append(thread)
+
+
+def _queue_event(event, room, sent_dt):
+    # only use the room data that's already loaded, the room name in
+    # particular can mean fetching every participant for old rooms
+    event.add("room_id", room.id)
+    room_name = getattr(room, "computed_name", None)
+    if room_name:
+        event.add("room_name", room_name)
+    event.add("room_level", room.level)
+
+    _ensure_flush_thread()
+    try:
+        _event_queue.put_nowait((event, room.date, sent_dt))
+    except Queue.Full:
+        g.stats.simple_event("robin.events.dropped")
+
+
 def message(room, message, sent_dt, request=None, context=None):
-    """Create and save a 'message' event.
+    """Create and queue a 'message' event.
 
     room: a RobinRoom object
     message: A string, <= 140 characters, representing the message sent
@@ -30,17 +98,13 @@ def message(room, message, sent_dt, request=None, context=None):
         context=context,
     )
 
-    event.add("room_id", room.id)
-    event.add("room_name", room.name)
-    event.add("room_age", _age_in_ms(room))
-    event.add("room_level", room.level)
     event.add_text("message_body", message)
 
-    g.events.save_event(event)
+    _queue_event(event, room, sent_dt)
 
 
 def vote(room, vote, sent_dt, request=None, context=None):
-    """Create and save a 'vote' event.
+    """Create and queue a 'vote' event.
 
     room: a RobinRoom object
     vote: A string, one of "INCREASE", "CONTINUE", or "ABANDON"
@@ -56,10 +120,6 @@ def vote(room, vote, sent_dt, request=None, context=None):
         context=context,
     )
 
-    event.add("room_id", room.id)
-    event.add("room_name", room.name)
-    event.add("room_age", _age_in_ms(room))
-    event.add("room_level", room.level)
     event.add("process_notes", vote)
 
-    g.events.save_event(event)
+    _queue_event(event, room, sent_dt)
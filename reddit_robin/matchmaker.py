@@ -10,10 +10,15 @@ from r2.models import Account
 from .models import RobinRoom
 
 
-def make_new_room():
+# The maximum number of waiting users to pull off the queue and pair up into
+# rooms at once.
+WAITINGLIST_BATCH_SIZE = 200
+
+
+def make_new_room(name_pieces=None):
     while True:
         try:
-            room = RobinRoom.create(level=0)
+            room = RobinRoom.create(level=0, name_pieces=name_pieces)
         except ValueError:
             continue
         else:
@@ -21,47 +26,131 @@ def make_new_room():
     return room
 
 
+def get_filling_slot(user):
+    """Pick which of the room-filling slots the user should be added to.
+
+    Each slot has its own current room and lock so that multiple waitinglist
+    consumers can fill rooms concurrently.
+
+    """
+
+    num_slots = max(1, g.live_config.get("robin_matchmaker_slots", 1))
+    return user._id % num_slots
+
+
+def _slot_cache_key(slot):
+    return "current_robin_room:%s" % slot
+
+
+def clear_filling_slots():
+    num_slots = max(1, g.live_config.get("robin_matchmaker_slots", 1))
+    g.cache.delete_multi([_slot_cache_key(slot) for slot in xrange(num_slots)])
+
+
+def add_to_filling_slot(user):
+    """Add the user to their slot's current room, starting a new one if needed.
+
+    The slot's room is filled once a second user is added to it.
+
+    """
+
+    slot = get_filling_slot(user)
+    cache_key = _slot_cache_key(slot)
+    with g.make_lock("robin_room", "slot_%s" % slot):
+        current_room_id = g.cache.get(cache_key)
+        if not current_room_id:
+            current_room = make_new_room(name_pieces=[user.name])
+        else:
+            try:
+                current_room = RobinRoom._byID(current_room_id)
+            except tdb_cassandra.NotFoundException:
+                current_room_id = None
+                current_room = make_new_room(name_pieces=[user.name])
+
+            if not current_room.is_alive or current_room.is_continued:
+                current_room_id = None
+                current_room = make_new_room(name_pieces=[user.name])
+
+        current_room.add_participants([user])
+        print "added %s to %s" % (user.name, current_room.id)
+        notify_room_assigned([user], current_room)
+
+        if current_room_id:
+            g.cache.delete(cache_key)
+            current_room.add_name_pieces([user.name])
+            current_room.persist_computed_name()
+            websockets.send_broadcast(
+                namespace="/robin/" + current_room.id,
+                type="updated_name",
+                payload={
+                    "room_name": current_room.name,
+                },
+            )
+        else:
+            g.cache.set(cache_key, current_room.id)
+
+
+def notify_room_assigned(users, room):
+    """Tell users waiting on the join page which room they've been put in."""
+    for user in users:
+        websockets.send_broadcast(
+            namespace="/robin-join/" + user._id36,
+            type="room_assigned",
+            payload={
+                "room_id": room.id,
+            },
+        )
+
+
+def fill_new_rooms(users):
+    """Pair up users into new level 0 rooms.
+
+    All of the membership rows for the new rooms are written in one batch.
+    Returns the users that were left over without a partner.
+
+    """
+
+    users_by_room = []
+    while len(users) >= 2:
+        pair, users = users[:2], users[2:]
+        room = make_new_room(name_pieces=[user.name for user in pair])
+        users_by_room.append((room, pair))
+
+    if users_by_room:
+        RobinRoom.add_participants_multi(users_by_room)
+
+    for room, pair in users_by_room:
+        print "added %s to %s" % (", ".join(u.name for u in pair), room.id)
+        notify_room_assigned(pair, room)
+
+    return users
+
+
 def run_waitinglist():
     @g.stats.amqp_processor("robin_waitinglist_q")
-    def process_waitinglist(msg):
-        user_id36 = msg.body
-        user = Account._byID36(user_id36, data=True, stale=True)
-        if RobinRoom.get_room_for_user(user):
-            print "%s already in room" % user.name
-            return
-
-        with g.make_lock("robin_room", "global"):
-            current_room_id = g.cache.get("current_robin_room")
-            if not current_room_id:
-                current_room = make_new_room()
-            else:
-                try:
-                    current_room = RobinRoom._byID(current_room_id)
-                except tdb_cassandra.NotFoundException:
-                    current_room_id = None
-                    current_room = make_new_room()
-
-                if not current_room.is_alive or current_room.is_continued:
-                    current_room_id = None
-                    current_room = make_new_room()
-
-            current_room.add_participants([user])
-            print "added %s to %s" % (user.name, current_room.id)
-
-            if current_room_id:
-                g.cache.delete("current_robin_room")
-                current_room.persist_computed_name()
-                websockets.send_broadcast(
-                    namespace="/robin/" + current_room.id,
-                    type="updated_name",
-                    payload={
-                        "room_name": current_room.name,
-                    },
-                )
+    def process_waitinglist(msgs, chan):
+        # the same user may have been queued more than once
+        user_id36s = list({msg.body for msg in msgs})
+        users_by_id36 = Account._byID36(user_id36s, data=True, stale=True)
+        users = sorted(users_by_id36.values(), key=lambda user: user._id)
+
+        room_ids_by_user_id = RobinRoom.get_room_ids_for_users(users)
+        waiting_users = []
+        for user in users:
+            if user._id in room_ids_by_user_id:
+                print "%s already in room" % user.name
             else:
-                g.cache.set("current_robin_room", current_room.id)
+                waiting_users.append(user)
+
+        leftover_users = fill_new_rooms(waiting_users)
+        for user in leftover_users:
+            add_to_filling_slot(user)
 
-    amqp.consume_items("robin_waitinglist_q", process_waitinglist)
+    amqp.handle_items(
+        "robin_waitinglist_q",
+        process_waitinglist,
+        limit=WAITINGLIST_BATCH_SIZE,
+    )
 
 
 def add_to_waitinglist(user):
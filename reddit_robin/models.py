@@ -1,13 +1,115 @@
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
 from datetime import datetime, timedelta
+import json
 import math
+import time
+import uuid
 
-from pycassa.system_manager import TIME_UUID_TYPE
+import pytz
+from pycassa.batch import Mutator
+from pycassa.system_manager import COUNTER_COLUMN_TYPE, TIME_UUID_TYPE
+from pycassa.util import convert_uuid_to_time
 from pylons import app_globals as g
 
 from r2.lib.db import tdb_cassandra
+from r2.lib.utils import in_chunks, to36
 from r2.models import Account, Subreddit, SubredditExists
 
 
+# How long each room will last at each level before merging happens.
+DEFAULT_LEVEL_TIME = timedelta(minutes=32)
+LEVEL_TIMINGS = defaultdict(lambda: DEFAULT_LEVEL_TIME)
+LEVEL_TIMINGS.update({
+    0: timedelta(minutes=2),
+    1: timedelta(minutes=4),
+    2: timedelta(minutes=8),
+    3: timedelta(minutes=16),
+    # >=4: timedelta(minutes=DEFAULT_LEVEL_TIME),
+})
+
+
+# Rooms are cached briefly so that the chat hot path doesn't go to Cassandra
+# for every message. g.cache also has a request-local layer, so repeated
+# lookups within one request don't leave the process at all.
+ROOM_CACHE_TTL = 10
+
+# Each room's participant ids are cached as a packed sorted array so that
+# is_participant can be answered without a read from Cassandra. The array is
+# updated in place (under a lock, so it can't race with a rebuild from the
+# row) whenever membership changes, so the TTL is only a safety net.
+MEMBERSHIP_CACHE_TTL = 10 * 60
+
+# The chat page's user list is cached for a few seconds so that a storm of
+# reconnects (e.g. after a websocket node restart) only builds it once.
+USER_LIST_CACHE_TTL = 5
+
+
+# How long a user is considered present in a room without a heartbeat.
+PRESENCE_TTL = timedelta(minutes=10)
+
+
+def get_reap_time(room):
+    return room.date + LEVEL_TIMINGS[room.level]
+
+
+def _generate_sr_names(room_name):
+    tries = 0
+    generated_name = room_name.replace('-', '').replace('_', '')[:20]
+
+    while tries < 20:
+        print 'generated %s for sr name candidate' % generated_name
+        yield str(generated_name)
+        generated_name = '%s%s' % (generated_name[:18], tries)
+        tries += 1
+
+
+def create_sr_for_room_name(room_name):
+    """Create a private subreddit named after a room.
+
+    Returns the new Subreddit, or None if no usable name could be found.
+
+    """
+
+    subreddit = None
+
+    print "attempting to create sr for %s" % room_name
+    candidates = list(_generate_sr_names(room_name))
+
+    # check all the candidates with one lookup rather than a failed write
+    # per collision
+    existing = Subreddit._by_name(candidates)
+    taken = {name.lower() for name in existing}
+
+    for name in candidates:
+        if name.lower() in taken:
+            print 'subreddit %s already exists' % name
+            continue
+
+        try:
+            subreddit = Subreddit._new(
+                name=name,
+                title=room_name[:100],
+                author_id=Account.system_user()._id,
+                ip='0.0.0.0',
+                type='private',
+            )
+            break
+        except SubredditExists:
+            # someone took the name since the lookup
+            print 'subreddit %s already exists' % name
+            continue
+        except ValueError:
+            print 'bad subreddit name, giving up: %s' % name
+            return subreddit
+    else:
+        print "gave up attempting to create sr for %s" % room_name
+        return subreddit
+
+    return subreddit
+
+
 class RobinRoom(tdb_cassandra.UuidThing):
     _use_db = True
     _connection_pool = 'main'
@@ -21,6 +123,7 @@ class RobinRoom(tdb_cassandra.UuidThing):
         'is_abandoned',
         'is_merged',
         'is_continued',
+        'has_vote_tally',
     )
     _date_props = (
         'last_prompt_time',
@@ -34,12 +137,16 @@ class RobinRoom(tdb_cassandra.UuidThing):
         is_abandoned=False,
         is_merged=False,
         is_continued=False,
+        has_vote_tally=False,
     )
 
     @classmethod
-    def create(cls, level):
-        room = cls(level=level)
+    def create(cls, level, name_pieces=None):
+        room = cls(level=level, has_vote_tally=True)
+        if name_pieces:
+            room._set_name_pieces(name_pieces)
         room._commit()
+        RoomsByReapMinute.add_room(room, get_reap_time(room))
 
         g.stats.simple_event('robin.room.make_new')
         g.stats.flush()
@@ -68,6 +175,39 @@ class RobinRoom(tdb_cassandra.UuidThing):
         """Convert UUID to string"""
         return str(self._id)
 
+    @classmethod
+    def _cache_key(cls, room_id):
+        return "robin:%s:%s" % (cls.__name__, room_id)
+
+    @classmethod
+    def get_cached(cls, room_id):
+        """Look up a room by id through the room cache.
+
+        Raises tdb_cassandra.NotFound if the room doesn't exist, just like
+        _byID.
+
+        """
+
+        try:
+            room_uuid = uuid.UUID(str(room_id))
+        except ValueError:
+            raise tdb_cassandra.NotFound("%s %s" % (cls.__name__, room_id))
+
+        key = cls._cache_key(room_uuid)
+        columns = g.cache.get(key)
+        if columns is None:
+            try:
+                columns = dict(cls._cf.get(room_uuid))
+            except tdb_cassandra.NotFoundException:
+                raise tdb_cassandra.NotFound("%s %s" % (cls.__name__, room_id))
+            g.cache.set(key, columns, time=ROOM_CACHE_TTL)
+
+        return cls._from_serialized_columns(room_uuid, columns)
+
+    def _commit(self, *args, **kwargs):
+        tdb_cassandra.UuidThing._commit(self, *args, **kwargs)
+        g.cache.delete(self._cache_key(self._id))
+
     @property
     def name(self):
         if hasattr(self, "computed_name"):
@@ -83,6 +223,26 @@ class RobinRoom(tdb_cassandra.UuidThing):
         self._name = self.make_room_name(user_names)
         return self._name
 
+    def _get_name_pieces(self):
+        name_pieces = getattr(self, "name_pieces", None)
+        if name_pieces:
+            return name_pieces.split(",")
+
+    def _set_name_pieces(self, pieces):
+        # usernames can't contain commas so they're safe to join on
+        self.name_pieces = ",".join(pieces)
+        self.computed_name = self.make_room_name(pieces)
+
+    def add_name_pieces(self, pieces):
+        """Update the room name with new pieces (usually the names of users
+        that were just added) without refetching every participant."""
+        current_pieces = self._get_name_pieces()
+        if current_pieces is None:
+            # rooms created before name pieces were stored will have their
+            # name computed from all participants by the name property
+            return
+        self._set_name_pieces(current_pieces + pieces)
+
     def persist_computed_name(self):
         """Save the room name to C*"""
         self.computed_name = self.name
@@ -91,14 +251,116 @@ class RobinRoom(tdb_cassandra.UuidThing):
     def add_participants(self, users):
         ParticipantVoteByRoom.add_participants(self, users)
         RoomsByParticipant.add_users_to_room(users, self)
+        RoomAssignmentByParticipant.set_assignment(
+            [user._id36 for user in users], self,
+            RoomAssignmentByParticipant.ALIVE)
+        self._update_member_ids(added_ids=[user._id for user in users])
+
+    @classmethod
+    def add_participants_multi(cls, users_by_room):
+        """Add users to many rooms with a single batch mutation.
+
+        users_by_room is a list of (room, users) tuples.
+
+        """
+
+        num_users = sum(len(users) for room, users in users_by_room)
+        mutator = Mutator(
+            ParticipantVoteByRoom._cf.pool,
+            queue_size=2 * num_users + len(users_by_room),
+            write_consistency_level=tdb_cassandra.CL.QUORUM,
+        )
+        with mutator as b:
+            for room, users in users_by_room:
+                room._batch_add_participants(b, users)
+
+        # these are the complete memberships for brand new rooms, so the
+        # membership cache can be filled in directly
+        for room, users in users_by_room:
+            room._cache_member_ids(user._id for user in users)
+            RobinRoomVoteTally.update(room, {NOVOTE: len(users)})
+
+    def _batch_add_participants(self, b, users):
+        """Queue the writes that add users to the room on a Mutator."""
+        vote_rowkey = ParticipantVoteByRoom._rowkey(self)
+        vote_columns = {user._id36: NOVOTE for user in users}
+        b.insert(ParticipantVoteByRoom._cf, vote_rowkey, vote_columns)
+
+        assignment = RoomAssignmentByParticipant._columns(
+            self, RoomAssignmentByParticipant.ALIVE)
+        for user in users:
+            rowkey = RoomsByParticipant._rowkey(user)
+            b.insert(RoomsByParticipant._cf, rowkey, {self._id: ""})
+            b.insert(RoomAssignmentByParticipant._cf, user._id36, assignment)
 
     def remove_participants(self, users):
         ParticipantVoteByRoom.remove_participants(self, users)
         RoomsByParticipant.remove_users_from_room(users, self)
+        RoomAssignmentByParticipant.set_assignment(
+            [user._id36 for user in users], self,
+            RoomAssignmentByParticipant.EXITED)
+        self._update_member_ids(removed_ids=[user._id for user in users])
+
+    def _membership_cache_key(self):
+        return "robin:members:%s" % self._id
+
+    def _cache_member_ids(self, participant_ids):
+        packed = array("l", sorted(participant_ids)).tostring()
+        key = self._membership_cache_key()
+        g.cache.set(key, packed, time=MEMBERSHIP_CACHE_TTL)
+        return packed
+
+    def _membership_lock(self):
+        return g.make_lock("robin_room", "members_%s" % self._id)
+
+    def _update_member_ids(self, added_ids=(), removed_ids=()):
+        """Apply a membership change that's already been written to C*.
+
+        A reader rebuilding the array holds the same lock while it reads the
+        row, so either it sees this change or this change is applied on top
+        of what it cached.
+
+        """
+
+        key = self._membership_cache_key()
+        with self._membership_lock():
+            packed = g.cache.get(key, allow_local=False)
+            if packed is None:
+                # the next reader will rebuild it from the row
+                return
+
+            member_ids = array("l")
+            member_ids.fromstring(packed)
+            participant_ids = set(member_ids)
+            participant_ids.update(added_ids)
+            participant_ids.difference_update(removed_ids)
+            self._cache_member_ids(participant_ids)
+
+    def get_member_ids(self):
+        """Return a sorted array of the room's participant ids.
+
+        This is served from the membership cache and only falls back to
+        reading the full ParticipantVoteByRoom row when it isn't cached.
+
+        """
+
+        key = self._membership_cache_key()
+        packed = g.cache.get(key)
+        if packed is None:
+            with self._membership_lock():
+                packed = g.cache.get(key, allow_local=False)
+                if packed is None:
+                    packed = self._cache_member_ids(
+                        self.get_all_participants())
+
+        member_ids = array("l")
+        member_ids.fromstring(packed)
+        return member_ids
 
     def is_participant(self, user):
-        vote = ParticipantVoteByRoom.get_vote(self, user)
-        return bool(vote)
+        member_ids = self.get_member_ids()
+        i = bisect_left(member_ids, user._id)
+        return i < len(member_ids) and member_ids[i] == user._id
 
     def get_all_participants(self):
         return ParticipantVoteByRoom.get_all_participant_ids(self)
@@ -109,93 +371,276 @@ class RobinRoom(tdb_cassandra.UuidThing):
     def get_all_votes(self):
         return ParticipantVoteByRoom.get_all_votes(self)
 
+    @classmethod
+    def get_all_votes_multi(cls, rooms):
+        return ParticipantVoteByRoom.get_all_votes_multi(rooms)
+
+    @classmethod
+    def get_vote_tallies_multi(cls, rooms):
+        return RobinRoomVoteTally.get_tallies_multi(rooms)
+
+    def get_snapshot(self):
+        """Return the room's name and a list of its users for the chat page.
+
+        Each user is a dict of name, present and vote. The vote and presence
+        rows are each read once and the result is cached briefly, so a storm
+        of reconnects only reads them once per room.
+
+        """
+
+        key = "robin:snapshot:%s" % self._id
+        snapshot = g.cache.get(key)
+        if snapshot is not None:
+            if not hasattr(self, "computed_name"):
+                self._name = snapshot[0]
+            return snapshot
+
+        all_votes = self.get_all_votes()
+        all_present_ids = self.get_present_participants()
+        users = Account._byID(all_votes.keys(), data=True,
+                              return_dict=False, stale=True)
+
+        if (not hasattr(self, "computed_name") and
+                not hasattr(self, "_name")):
+            # legacy rooms derive their name from participants, which we've
+            # already loaded
+            self._name = self.make_room_name([user.name for user in users])
+
+        user_list = [
+            {
+                "name": user.name,
+                "present": user._id in all_present_ids,
+                "vote": all_votes.get(user._id),
+            }
+            for user in users
+        ]
+        snapshot = (self.name, user_list)
+        g.cache.set(key, snapshot, time=USER_LIST_CACHE_TTL)
+        return snapshot
+
     def set_vote(self, user, vote):
         ParticipantVoteByRoom.set_vote(self, user, vote)
 
-    def abandon(self):
+    def abandon(self, participant_ids=None):
         self.last_reap_time = datetime.now(g.tz)
         self.is_alive = False
         self.is_abandoned = True
         self._commit()
+        RoomsByReapMinute.remove_room(self, get_reap_time(self))
+
+        if participant_ids is None:
+            participant_ids = self.get_all_participants()
+        RoomAssignmentByParticipant.set_assignment(
+            [to36(_id) for _id in participant_ids], self,
+            RoomAssignmentByParticipant.DEAD)
 
     def continu(self):
         self.is_continued = True
         self._commit()
-
-    def _generate_sr_name(self):
-        tries = 0
-        generated_name = self.name.replace('-', '').replace('_', '')[:20]
-
-        while tries < 20:
-            print 'generated %s for sr name candidate' % generated_name
-            yield str(generated_name)
-            generated_name = '%s%s' % (generated_name[:18], tries)
-            tries += 1
+        RoomsByReapMinute.remove_room(self, get_reap_time(self))
 
     def create_sr(self):
-        subreddit = None
+        subreddit = create_sr_for_room_name(self.name)
+        if subreddit:
+            self.subreddit_name = subreddit.name
+            self._commit()
+        return subreddit
 
-        print "attempting to create sr for %s" % self.name
-        for name in self._generate_sr_name():
-            try:
-                subreddit = Subreddit._new(
-                    name=name,
-                    title=self.name[:100],
-                    author_id=Account.system_user()._id,
-                    ip='0.0.0.0',
-                    type='private',
-                )
-                break
-            except SubredditExists:
-                print 'subreddit %s already exists' % name
-                continue
-            except ValueError:
-                print 'bad subreddit name, giving up: %s' % name
-                return subreddit
+    @classmethod
+    def merge_many(cls, groups):
+        """Merge each group of rooms into a new room.
+
+        groups is a list of (rooms, all_participants) tuples, where
+        all_participants can be None if the caller hasn't already loaded the
+        Accounts of the rooms' participants. The accounts that are needed are
+        loaded together, and the new rooms' memberships and the old rooms'
+        merged state are written in one batch. Returns the new rooms in the
+        same order as groups.
+
+        """
+
+        to_load = [
+            room for rooms, all_participants in groups
+            if all_participants is None
+            for room in rooms
+        ]
+        votes_by_room_id = cls.get_all_votes_multi(to_load)
+        user_ids = set()
+        for votes_by_user in votes_by_room_id.itervalues():
+            user_ids.update(votes_by_user.iterkeys())
+        if user_ids:
+            accounts_by_id = Account._byID(
+                user_ids, data=True, return_dict=True, stale=True)
         else:
-            print "gave up attempting to create sr for %s" % self.name
-            return subreddit
+            accounts_by_id = {}
+
+        merges = []
+        for rooms, all_participants in groups:
+            if all_participants is None:
+                all_participant_ids = set()
+                for room in rooms:
+                    all_participant_ids.update(votes_by_room_id[room._id])
+                all_participants = [
+                    accounts_by_id[_id] for _id in all_participant_ids
+                    if _id in accounts_by_id
+                ]
+
+            # the new room's name is built from its parents' names rather
+            # than from every participant so it doesn't get more expensive
+            # to compute as rooms grow
+            new_room_level = max(room.level for room in rooms) + 1
+            new_room = cls(level=new_room_level, has_vote_tally=True)
+            new_room._set_name_pieces([room.name for room in rooms])
+            new_room._commit()
+            merges.append((rooms, new_room, all_participants))
+
+        now = datetime.now(g.tz)
+        tombstone = {
+            "last_reap_time": cls._serialize_column("last_reap_time", now),
+            "is_alive": cls._serialize_column("is_alive", False),
+            "is_merged": cls._serialize_column("is_merged", True),
+        }
+        num_writes = sum(
+            2 * len(all_participants) + 2 * len(rooms) + 2
+            for rooms, new_room, all_participants in merges
+        )
+        mutator = Mutator(
+            cls._cf.pool,
+            queue_size=num_writes,
+            write_consistency_level=tdb_cassandra.CL.QUORUM,
+        )
+        with mutator as b:
+            for rooms, new_room, all_participants in merges:
+                new_room._batch_add_participants(b, all_participants)
+                b.insert(
+                    RoomsByReapMinute._cf,
+                    RoomsByReapMinute._rowkey(get_reap_time(new_room)),
+                    {new_room._id: ""},
+                    ttl=RoomsByReapMinute._ttl,
+                )
 
-        self.subreddit_name = subreddit.name
-        self._commit()
+                columns = dict(tombstone)
+                columns["next_room"] = cls._serialize_column(
+                    "next_room", new_room.id)
+                for room in rooms:
+                    b.insert(cls._cf, room._id, columns)
+                    b.remove(
+                        RoomsByReapMinute._cf,
+                        RoomsByReapMinute._rowkey(get_reap_time(room)),
+                        [room._id],
+                    )
+
+        old_room_ids = []
+        for rooms, new_room, all_participants in merges:
+            new_room._cache_member_ids(user._id for user in all_participants)
+            RobinRoomVoteTally.update(
+                new_room, {NOVOTE: len(all_participants)})
+            g.stats.simple_event('robin.room.make_new')
+
+            for room in rooms:
+                room.last_reap_time = now
+                room.is_alive = False
+                room.is_merged = True
+                room.next_room = new_room.id
+                old_room_ids.append(room._id)
+        g.cache.delete_multi([cls._cache_key(_id) for _id in old_room_ids])
+        g.stats.flush()
 
-        return subreddit
+        return [new_room for rooms, new_room, all_participants in merges]
 
     @classmethod
-    def merge(cls, room1, room2):
-        new_room_level = max([room1.level, room2.level]) + 1
-        all_participant_ids = (room1.get_all_participants() |
-            room2.get_all_participants())
-        all_participants = Account._byID(
-            all_participant_ids, data=True, return_dict=False)
-
-        new_room = cls.create(level=new_room_level)
-        new_room.add_participants(all_participants)
-        new_room.persist_computed_name()
+    def _get_room_for_user_unassigned(cls, user):
+        """Find the user's room without using RoomAssignmentByParticipant.
 
-        for room in (room1, room2):
-            room.last_reap_time = datetime.now(g.tz)
-            room.is_alive = False
-            room.is_merged = True
-            room.next_room = new_room.id
-            room._commit()
+        This is only needed for users that joined a room before room
+        assignments were recorded.
 
-        return new_room
+        """
 
-    @classmethod
-    def get_room_for_user(cls, user):
         room_id = RoomsByParticipant.get_room_id(user)
         if room_id is None:
             return
 
         try:
-            room = cls._byID(room_id)
-        except tdb_cassandra.NotFoundException:
+            room = cls.get_cached(room_id)
+        except tdb_cassandra.NotFound:
             return
 
         if room.is_alive and room.is_participant(user):
             return room
 
+    @classmethod
+    def get_room_for_user(cls, user):
+        assignment = RoomAssignmentByParticipant.get_assignment(user)
+        if assignment is None:
+            return cls._get_room_for_user_unassigned(user)
+
+        room_id, status = assignment
+        if status != RoomAssignmentByParticipant.ALIVE:
+            return
+
+        try:
+            room = cls.get_cached(room_id)
+        except tdb_cassandra.NotFound:
+            return
+
+        if room.is_alive:
+            return room
+
+    @classmethod
+    def get_room_id_for_user(cls, user):
+        """Return the id of the user's live room using a single read."""
+        assignment = RoomAssignmentByParticipant.get_assignment(user)
+        if assignment is None:
+            room = cls._get_room_for_user_unassigned(user)
+            return room.id if room else None
+
+        room_id, status = assignment
+        if status == RoomAssignmentByParticipant.ALIVE:
+            return room_id
+
+    @classmethod
+    def get_room_ids_for_users(cls, users):
+        """Return a dict of user._id -> room id for users in a live room."""
+        assignments = RoomAssignmentByParticipant.get_assignments(users)
+
+        ret = {}
+        unassigned = []
+        for user in users:
+            if user._id not in assignments:
+                unassigned.append(user)
+                continue
+
+            room_id, status = assignments[user._id]
+            if status == RoomAssignmentByParticipant.ALIVE:
+                ret[user._id] = room_id
+
+        ret.update(cls._get_room_ids_for_users_unassigned(unassigned))
+        return ret
+
+    @classmethod
+    def _get_room_ids_for_users_unassigned(cls, users):
+        """Bulk version of _get_room_for_user_unassigned.
+
+        Most of these are users that have never been in a room, so their
+        RoomsByParticipant rows are all read with one multiget.
+
+        """
+
+        room_ids_by_user_id = RoomsByParticipant.get_room_ids_multi(users)
+        if not room_ids_by_user_id:
+            return {}
+
+        room_ids = set(room_ids_by_user_id.itervalues())
+        rooms_by_id = cls._byID(room_ids, return_dict=True)
+
+        ret = {}
+        for user in users:
+            room = rooms_by_id.get(room_ids_by_user_id.get(user._id))
+            if room and room.is_alive and room.is_participant(user):
+                ret[user._id] = room.id
+        return ret
+
     @classmethod
     def generate_all_rooms(cls):
         for _id, columns in cls._cf.get_range():
@@ -208,6 +653,46 @@ class RobinRoom(tdb_cassandra.UuidThing):
             if room.is_alive and not room.is_continued:
                 yield room
 
+    @classmethod
+    def generate_due_rooms(cls, until):
+        """Yield voting rooms that are indexed as due for reaping by `until`.
+
+        Unlike generate_voting_rooms this only looks at the rooms in the
+        RoomsByReapMinute index, so the cost is proportional to the number of
+        rooms that are due rather than the total number of rooms.
+
+        """
+
+        rowkeys_by_room_id = RoomsByReapMinute.get_due_room_ids(until)
+        room_ids = rowkeys_by_room_id.keys()
+        for chunk in in_chunks(room_ids, RoomsByReapMinute.CHUNK_SIZE):
+            rooms_by_id = cls._byID(chunk, return_dict=True)
+            for room_id in chunk:
+                room = rooms_by_id.get(room_id)
+                if room and room.is_alive and not room.is_continued:
+                    yield room
+                else:
+                    # the room was reaped or moved since it was indexed
+                    rowkey = rowkeys_by_room_id[room_id]
+                    RoomsByReapMinute.remove_room_id(room_id, rowkey)
+
+    @classmethod
+    def generate_queued_rooms(cls):
+        """Yield (room, queued_at) for rooms waiting in RoomsAwaitingMerge."""
+
+        queued = RoomsAwaitingMerge.get_queued_room_ids()
+        room_ids = queued.keys()
+        for chunk in in_chunks(room_ids, RoomsAwaitingMerge.CHUNK_SIZE):
+            rooms_by_id = cls._byID(chunk, return_dict=True)
+            for room_id in chunk:
+                level, queued_at = queued[room_id]
+                room = rooms_by_id.get(room_id)
+                if room and room.is_alive and not room.is_continued:
+                    yield room, queued_at
+                else:
+                    # the room was reaped or moved while it was queued
+                    RoomsAwaitingMerge.remove_room_id(room_id, level)
+
     def has_prompted(self):
         return True if getattr(self, 'last_prompt_time', False) else False
 
@@ -221,46 +706,520 @@ class RobinRoom(tdb_cassandra.UuidThing):
 
 
 class RobinRoomDead(RobinRoom):
-    """An exact copy of RobinRoom for storing dead rooms."""
+    """An exact copy of RobinRoom for storing dead rooms.
+
+    New dead rooms are stored in RobinRoomArchive instead, this is only kept
+    around so that rooms moved before the archive existed can be found.
+
+    """
     _use_db = True
     _type_prefix = "RobinRoomDead"
 
 
-def move_dead_rooms():
-    """Move dead rooms so that only live ones exist in RobinRoom.
+class ArchivedRobinRoom(object):
+    """A read-only dead room loaded from RobinRoomArchive."""
 
-    This will ensure that get_range() style queries on the RobinRoom CF stay
-    as fast as possible.
+    def __init__(self, _id, name, level, participant_ids, subreddit_name=None,
+                 next_room=None):
+        self._id = _id
+        self.name = name
+        self.level = level
+        self.participant_ids = set(participant_ids)
+        self.subreddit_name = subreddit_name
+        self.next_room = next_room
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.id)
+
+    @property
+    def id(self):
+        return str(self._id)
+
+    def get_all_participants(self):
+        return self.participant_ids
+
+    def create_sr(self):
+        subreddit = create_sr_for_room_name(self.name)
+        if subreddit:
+            self.subreddit_name = subreddit.name
+            RobinRoomArchive.archive([self])
+        return subreddit
+
+
+class RobinRoomArchive(tdb_cassandra.View):
+    """Compact copies of dead rooms, bucketed by the day they were created.
+
+    Only the fields needed to look rooms up later are kept. Every column is
+    written with a TTL so whole days of rooms expire together, and a day's
+    rooms can be scanned for analytics by reading a single row. A room's
+    bucket can be derived from its time UUID, so finding a single room is
+    still one read.
 
     """
 
-    count = 0
-    start = datetime.now(g.tz)
-    cutoff = datetime.now(g.tz) - timedelta(days=2)
-    for _id, columns in RobinRoom._cf.get_range():
-        room = RobinRoom._from_serialized_columns(_id, columns)
+    _use_db = True
+    _connection_pool = 'main'
+
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    _ttl = int(timedelta(days=90).total_seconds())
+
+    @classmethod
+    def _rowkey_for_date(cls, dt):
+        return dt.astimezone(pytz.UTC).strftime("%Y%m%d")
+
+    @classmethod
+    def _rowkey(cls, room_id):
+        created = datetime.fromtimestamp(
+            convert_uuid_to_time(room_id), pytz.UTC)
+        return cls._rowkey_for_date(created)
+
+    @classmethod
+    def _serialize(cls, room):
+        return json.dumps({
+            "name": room.name,
+            "level": room.level,
+            "participants": [to36(_id) for _id in room.participant_ids],
+            "subreddit_name": room.subreddit_name,
+            "next_room": room.next_room,
+        })
+
+    @classmethod
+    def _deserialize(cls, room_id, value):
+        d = json.loads(value)
+        return ArchivedRobinRoom(
+            _id=room_id,
+            name=d["name"],
+            level=d["level"],
+            participant_ids=[int(id36, 36) for id36 in d["participants"]],
+            subreddit_name=d["subreddit_name"],
+            next_room=d["next_room"],
+        )
+
+    @classmethod
+    def from_room(cls, room, participant_ids, name=None):
+        return ArchivedRobinRoom(
+            _id=room._id,
+            name=room.name if name is None else name,
+            level=room.level,
+            participant_ids=participant_ids,
+            subreddit_name=getattr(room, "subreddit_name", None),
+            next_room=getattr(room, "next_room", None),
+        )
+
+    @classmethod
+    def archive(cls, archived_rooms, mutator=None):
+        """Write ArchivedRobinRooms, optionally as part of a larger batch."""
+        if mutator is None:
+            with cls._cf.batch() as b:
+                for archived_room in archived_rooms:
+                    b.insert(
+                        cls._rowkey(archived_room._id),
+                        {archived_room._id: cls._serialize(archived_room)},
+                        ttl=cls._ttl,
+                    )
+        else:
+            for archived_room in archived_rooms:
+                mutator.insert(
+                    cls._cf,
+                    cls._rowkey(archived_room._id),
+                    {archived_room._id: cls._serialize(archived_room)},
+                    ttl=cls._ttl,
+                )
+
+    @classmethod
+    def get(cls, room_id):
+        """Return the ArchivedRobinRoom with this id.
+
+        Raises tdb_cassandra.NotFound if it isn't in the archive.
+
+        """
+
+        try:
+            room_uuid = uuid.UUID(str(room_id))
+        except ValueError:
+            raise tdb_cassandra.NotFound("archived room %s" % room_id)
+
+        rowkey = cls._rowkey(room_uuid)
+        try:
+            columns = cls._cf.get(rowkey, columns=[room_uuid])
+        except tdb_cassandra.NotFoundException:
+            raise tdb_cassandra.NotFound("archived room %s" % room_id)
+
+        return cls._deserialize(room_uuid, columns[room_uuid])
+
+    @classmethod
+    def generate_rooms_for_day(cls, day):
+        """Yield every archived room that was created on the day of `day`."""
+        rowkey = cls._rowkey_for_date(day)
+        try:
+            for room_id, value in cls._cf.xget(rowkey):
+                yield cls._deserialize(room_id, value)
+        except tdb_cassandra.NotFoundException:
+            return
+
+    @classmethod
+    def remove_day(cls, day):
+        """Remove a whole day of archived rooms before its TTL is up."""
+        cls._cf.remove(cls._rowkey_for_date(day))
+
+
+# move_dead_rooms pages through RobinRoom this many rows at a time, and only
+# looks at MOVE_DEAD_ROOMS_MAX_ROWS rows per run. The last row seen is saved
+# so the next run resumes from there.
+MOVE_DEAD_ROOMS_PAGE_SIZE = 500
+MOVE_DEAD_ROOMS_MAX_ROWS = 50000
+MOVE_DEAD_ROOMS_CURSOR_KEY = "robin:move_dead_rooms:cursor"
+
+
+def _reindex_overdue_rooms(rooms, queued_room_ids):
+    """Put voting rooms the reaper can no longer see back in its index.
+
+    The reaper only looks RoomsByReapMinute.LOOKBACK back in the index, so a
+    room whose bucket falls out of that window (e.g. if the reaper was down
+    for a while) would otherwise stay alive forever.
+
+    """
+
+    now = datetime.now(g.tz)
+    overdue_before = now - RoomsByReapMinute.LOOKBACK
+    overdue = [
+        room for room in rooms
+        if room.is_alive and not room.is_continued and
+            room._id not in queued_room_ids and
+            get_reap_time(room) < overdue_before
+    ]
+    if overdue:
+        RoomsByReapMinute.add_rooms(overdue, now)
+        g.stats.simple_event('robin.room.reindex_overdue', len(overdue))
+
+
+def _move_dead_rooms_page(page, cutoff, queued_room_ids):
+    """Move the dead rooms in a page of (_id, columns) RobinRoom rows.
+
+    The participant and presence rows needed to decide whether continued
+    rooms are lonely are fetched in bulk, and all the moves are written in a
+    single batch. Overdue voting rooms found along the way are re-indexed for
+    the reaper. Returns the number of rooms moved.
+
+    """
+
+    rooms = [
+        RobinRoom._from_serialized_columns(_id, columns)
+        for _id, columns in page
+    ]
+    _reindex_overdue_rooms(rooms, queued_room_ids)
+
+    continued_rooms = [room for room in rooms if room.is_continued]
+    votes_by_room_id = ParticipantVoteByRoom.get_all_votes_multi(rooms)
+    old_rooms = [room for room in continued_rooms if room.date <= cutoff]
+    present_ids_by_room_id = ParticipantPresenceByRoom.get_present_user_ids_multi(
+        old_rooms)
+
+    to_move = []
+    for room, (_id, columns) in zip(rooms, page):
         room_is_dead = not room.is_alive
 
         if room.is_continued:
-            num_active_participants = len(room.get_all_participants())
+            num_active_participants = len(votes_by_room_id[room._id])
             room_is_lonely = num_active_participants <= 1
         else:
             room_is_lonely = False
 
         if room.is_continued and room.date <= cutoff:
-            num_present_participants = len(room.get_present_participants())
+            num_present_participants = len(present_ids_by_room_id[room._id])
             room_is_old_and_lonely = num_present_participants <= 1
         else:
             room_is_old_and_lonely = False
 
         if room_is_dead or room_is_lonely or room_is_old_and_lonely:
-            RobinRoomDead._cf.insert(_id, columns)
-            RobinRoom._cf.remove(_id)
-            count += 1
+            to_move.append((room, _id, columns))
+
+    if not to_move:
+        return 0
+
+    # legacy rooms without a computed_name derive it from their participants,
+    # so load all of those accounts for the page at once
+    legacy_rooms = [
+        room for room, _id, columns in to_move
+        if not hasattr(room, "computed_name")
+    ]
+    legacy_user_ids = set()
+    for room in legacy_rooms:
+        legacy_user_ids.update(votes_by_room_id[room._id])
+    if legacy_user_ids:
+        accounts_by_id = Account._byID(
+            legacy_user_ids, data=True, return_dict=True, stale=True)
+    else:
+        accounts_by_id = {}
+    names_by_room_id = {}
+    for room in legacy_rooms:
+        names_by_room_id[room._id] = RobinRoom.make_room_name([
+            accounts_by_id[_id].name for _id in votes_by_room_id[room._id]
+            if _id in accounts_by_id
+        ])
+
+    mutator = Mutator(
+        RobinRoom._cf.pool,
+        queue_size=MOVE_DEAD_ROOMS_PAGE_SIZE,
+        write_consistency_level=tdb_cassandra.CL.QUORUM,
+    )
+    with mutator as b:
+        for room, _id, columns in to_move:
+            participant_ids = votes_by_room_id[room._id].keys()
+            archived_room = RobinRoomArchive.from_room(
+                room, participant_ids, name=names_by_room_id.get(room._id))
+            RobinRoomArchive.archive([archived_room], mutator=b)
+            b.remove(RobinRoom._cf, _id)
+
+            # abandoned and merged rooms already had their participants'
+            # assignments updated, but continued rooms are still live until
+            # they're moved
+            if room.is_alive:
+                assignment = RoomAssignmentByParticipant._columns(
+                    room, RoomAssignmentByParticipant.DEAD)
+                for user_id in votes_by_room_id[room._id]:
+                    b.insert(
+                        RoomAssignmentByParticipant._cf, to36(user_id),
+                        assignment)
+
+    g.cache.delete_multi(
+        [RobinRoom._cache_key(_id) for room, _id, columns in to_move])
+
+    return len(to_move)
+
+
+def move_dead_rooms(max_rows=MOVE_DEAD_ROOMS_MAX_ROWS):
+    """Move dead rooms so that only live ones exist in RobinRoom.
+
+    This will ensure that get_range() style queries on the RobinRoom CF stay
+    as fast as possible.
+
+    This runs as its own job rather than as part of the reaper. Each run
+    scans at most max_rows rows starting from where the last run stopped, so
+    it can make progress on a very large CF without taking too long. Since
+    it sees every room it also re-indexes voting rooms that have fallen out
+    of the reaper's lookback window.
+
+    """
+
+    count = 0
+    num_rows = 0
+    start = datetime.now(g.tz)
+    cutoff = datetime.now(g.tz) - timedelta(days=2)
+
+    queued_room_ids = set(RoomsAwaitingMerge.get_queued_room_ids())
+    cursor = g.cache.get(MOVE_DEAD_ROOMS_CURSOR_KEY)
+    rows = RobinRoom._cf.get_range(
+        start=cursor or "",
+        buffer_size=MOVE_DEAD_ROOMS_PAGE_SIZE,
+    )
+
+    page = []
+    last_id = None
+    finished = True
+    for _id, columns in rows:
+        # get_range includes the start key, which was handled last time
+        if cursor is not None and _id == cursor:
+            continue
+
+        page.append((_id, columns))
+        last_id = _id
+        num_rows += 1
+
+        if len(page) >= MOVE_DEAD_ROOMS_PAGE_SIZE:
+            count += _move_dead_rooms_page(page, cutoff, queued_room_ids)
+            page = []
+
+        if num_rows >= max_rows:
+            finished = False
+            break
+
+    if page:
+        count += _move_dead_rooms_page(page, cutoff, queued_room_ids)
+
+    if finished:
+        # we made it to the end of the CF, so start over next time
+        g.cache.delete(MOVE_DEAD_ROOMS_CURSOR_KEY)
+    else:
+        g.cache.set(MOVE_DEAD_ROOMS_CURSOR_KEY, last_id)
 
     g.stats.simple_event('robin.room.move_dead', count)
     g.stats.flush()
-    print "moved %s rooms in %s" % (count, datetime.now(g.tz) - start)
+    print "moved %s of %s rooms in %s" % (
+        count, num_rows, datetime.now(g.tz) - start)
+
+
+class RoomsByReapMinute(tdb_cassandra.View):
+    """Index of voting rooms bucketed by the minute they are due to be reaped.
+
+    The reaper and the voting prompter both run every minute, so rather than
+    scanning the entire RobinRoom CF they only read the buckets that are due.
+    Rooms are removed from the index when they are abandoned, merged or
+    continued.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    # rooms that are due but were never removed from the index (e.g. if the
+    # reaper died mid-run or the room couldn't be matched) will be found again
+    # as long as their bucket is within this window. move_dead_rooms re-indexes
+    # any that fall out of it.
+    LOOKBACK = timedelta(hours=1)
+    BUCKET_SIZE = timedelta(minutes=1)
+    CHUNK_SIZE = 100
+    _ttl = int(timedelta(days=2).total_seconds())
+
+    @classmethod
+    def _rowkey(cls, dt):
+        return dt.astimezone(pytz.UTC).strftime("%Y%m%d%H%M")
+
+    @classmethod
+    def _rowkeys_until(cls, until):
+        rowkeys = []
+        dt = until - cls.LOOKBACK
+        while dt <= until:
+            rowkeys.append(cls._rowkey(dt))
+            dt += cls.BUCKET_SIZE
+        return rowkeys
+
+    @classmethod
+    def add_room(cls, room, reap_time):
+        rowkey = cls._rowkey(reap_time)
+        columns = {room._id: ""}
+        cls._cf.insert(rowkey, columns, ttl=cls._ttl)
+
+    @classmethod
+    def add_rooms(cls, rooms, reap_time):
+        rowkey = cls._rowkey(reap_time)
+        columns = {room._id: "" for room in rooms}
+        cls._cf.insert(rowkey, columns, ttl=cls._ttl)
+
+    @classmethod
+    def remove_room(cls, room, reap_time):
+        rowkey = cls._rowkey(reap_time)
+        cls.remove_room_id(room._id, rowkey)
+
+    @classmethod
+    def remove_room_id(cls, room_id, rowkey):
+        cls._cf.remove(rowkey, [room_id])
+
+    @classmethod
+    def get_due_room_ids(cls, until):
+        """Return a dict of room id -> index rowkey for rooms due by `until`."""
+        ret = {}
+        rowkeys = cls._rowkeys_until(until)
+        for chunk in in_chunks(rowkeys, cls.CHUNK_SIZE):
+            rows = cls._cf.multiget(chunk)
+            for rowkey, columns in rows.iteritems():
+                for room_id in columns.iterkeys():
+                    ret[room_id] = rowkey
+        return ret
+
+
+class RoomsAwaitingMerge(tdb_cassandra.View):
+    """Rooms that voted to increase but couldn't be paired, by level.
+
+    Unmatched rooms wait here across reaper ticks instead of being sent back
+    through the reap index. The reaper includes them in every tick's ripe
+    rooms so they're re-decided from their current votes and can be paired
+    with rooms that become ripe later.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    CHUNK_SIZE = 100
+
+    @classmethod
+    def _rowkey(cls, level):
+        return str(level)
+
+    @classmethod
+    def add_room(cls, room, queued_at):
+        rowkey = cls._rowkey(room.level)
+        columns = {room._id: str(queued_at)}
+        cls._cf.insert(rowkey, columns)
+
+    @classmethod
+    def remove_room(cls, room):
+        cls.remove_room_id(room._id, room.level)
+
+    @classmethod
+    def remove_room_id(cls, room_id, level):
+        cls._cf.remove(cls._rowkey(level), [room_id])
+
+    @classmethod
+    def get_queued_room_ids(cls):
+        """Return a dict of room id -> (level, queued_at) for every level."""
+        ret = {}
+        rows = cls._cf.get_range(
+            column_count=ParticipantVoteByRoom._max_column_count)
+        for rowkey, columns in rows:
+            for room_id, queued_at in columns.iteritems():
+                ret[room_id] = (int(rowkey), float(queued_at))
+        return ret
+
+
+# The admin overview of voting rooms is precomputed by the
+# robin_update_room_summaries job and cached in pages of this many rooms so
+# /robin/all has a bounded cost to render.
+ROOM_SUMMARY_PAGE_SIZE = 100
+ROOM_SUMMARY_CACHE_TTL = 10 * 60
+ROOM_SUMMARY_KEY = "robin:summary"
+
+
+def set_room_summaries(summaries):
+    """Cache a list of room summary dicts as pages for the admin overview."""
+    pages = list(in_chunks(summaries, ROOM_SUMMARY_PAGE_SIZE)) or [[]]
+    to_cache = {
+        "%s:%s" % (ROOM_SUMMARY_KEY, i): page
+        for i, page in enumerate(pages, start=1)
+    }
+    to_cache[ROOM_SUMMARY_KEY] = {
+        "generated": time.time(),
+        "num_rooms": len(summaries),
+        "num_pages": len(pages),
+    }
+    g.cache.set_multi(to_cache, time=ROOM_SUMMARY_CACHE_TTL)
+
+
+def get_room_summaries(page):
+    """Return a tuple of (info, summaries) for a page of the overview.
+
+    info is None if the reaper hasn't cached an overview recently.
+
+    """
+
+    info = g.cache.get(ROOM_SUMMARY_KEY)
+    if not info:
+        return None, []
+    summaries = g.cache.get("%s:%s" % (ROOM_SUMMARY_KEY, page)) or []
+    return info, summaries
+
+
+def backfill_reap_index():
+    """Add all existing voting rooms to the RoomsByReapMinute index."""
+    now = datetime.now(g.tz)
+    count = 0
+    for room in RobinRoom.generate_voting_rooms():
+        reap_time = max(get_reap_time(room), now)
+        RoomsByReapMinute.add_room(room, reap_time)
+        count += 1
+    print "indexed %s rooms" % count
 
 
 NOVOTE = "NOVOTE"
@@ -283,6 +1242,10 @@ class ParticipantVoteByRoom(tdb_cassandra.View):
     _read_consistency_level = tdb_cassandra.CL.QUORUM
     _write_consistency_level = tdb_cassandra.CL.QUORUM
 
+    # multiget doesn't page through columns like xget does, so ask for enough
+    # columns to cover the largest possible room
+    _max_column_count = 100000
+
     @classmethod
     def _rowkey(cls, room):
         return room._id
@@ -292,13 +1255,46 @@ class ParticipantVoteByRoom(tdb_cassandra.View):
         rowkey = cls._rowkey(room)
         vote = NOVOTE
         columns = {user._id36: vote for user in users}
-        cls._cf.insert(rowkey, columns)
+
+        if not room.has_vote_tally:
+            cls._cf.insert(rowkey, columns)
+            return
+
+        with RobinRoomVoteTally.lock(room):
+            # users that are already in the room have their vote reset
+            old_votes = cls._get_votes(rowkey, columns.keys())
+            cls._cf.insert(rowkey, columns)
+
+            deltas = defaultdict(int)
+            deltas[vote] += len(users)
+            for old_vote in old_votes.itervalues():
+                deltas[old_vote] -= 1
+            RobinRoomVoteTally.update(room, deltas)
 
     @classmethod
     def remove_participants(cls, room, users):
         rowkey = cls._rowkey(room)
-        columns = {user._id36: "" for user in users}
-        cls._cf.remove(rowkey, columns)
+        user_id36s = [user._id36 for user in users]
+
+        if not room.has_vote_tally:
+            cls._cf.remove(rowkey, user_id36s)
+            return
+
+        with RobinRoomVoteTally.lock(room):
+            old_votes = cls._get_votes(rowkey, user_id36s)
+            cls._cf.remove(rowkey, user_id36s)
+
+            deltas = defaultdict(int)
+            for old_vote in old_votes.itervalues():
+                deltas[old_vote] -= 1
+            RobinRoomVoteTally.update(room, deltas)
+
+    @classmethod
+    def _get_votes(cls, rowkey, user_id36s):
+        try:
+            return cls._cf.get(rowkey, columns=user_id36s)
+        except tdb_cassandra.NotFoundException:
+            return {}
 
     @classmethod
     def get_all_participant_ids(cls, room):
@@ -339,11 +1335,168 @@ class ParticipantVoteByRoom(tdb_cassandra.View):
             ret[int(user_id36, 36)] = vote
         return ret
 
+    @classmethod
+    def get_all_votes_multi(cls, rooms):
+        """Return a dict of room._id -> {user_id: vote} in one multiget."""
+        rowkeys = [cls._rowkey(room) for room in rooms]
+        if not rowkeys:
+            return {}
+
+        rows = cls._cf.multiget(rowkeys, column_count=cls._max_column_count)
+
+        ret = {}
+        for rowkey in rowkeys:
+            columns = rows.get(rowkey, {})
+            ret[rowkey] = {
+                int(user_id36, 36): vote
+                for user_id36, vote in columns.iteritems()
+            }
+        return ret
+
     @classmethod
     def set_vote(cls, room, user, vote):
+        timestamp = int(time.time() * 1e6)
+        cls.set_votes_multi({room: {user._id36: (vote, timestamp)}})
+
+    @classmethod
+    def set_votes_multi(cls, votes_by_room):
+        """Write {room: {user_id36: (vote, timestamp)}}.
+
+        Each vote is written with its own timestamp, the time it was cast.
+        Votes from users that aren't in the room, or that are older than the
+        vote already stored, are skipped. Returns {room: {user_id36: vote}}
+        for the votes that were written.
+
+        Rooms without a tally are written in one batch. Rooms with one are
+        written one at a time while holding the room's tally lock, so that
+        two writers can't both move the same old vote.
+
+        """
+
+        rooms = [room for room, votes in votes_by_room.iteritems() if votes]
+        untallied = [room for room in rooms if not room.has_vote_tally]
+        tallied = [room for room in rooms if room.has_vote_tally]
+
+        written_by_room, _ = cls._write_votes(
+            untallied, votes_by_room)
+
+        for room in tallied:
+            with RobinRoomVoteTally.lock(room):
+                written, deltas = cls._write_votes([room], votes_by_room)
+                RobinRoomVoteTally.update(room, deltas[room])
+            written_by_room.update(written)
+
+        return written_by_room
+
+    @classmethod
+    def _write_votes(cls, rooms, votes_by_room):
+        """Write the votes for rooms in one batch.
+
+        Returns a tuple of ({room: {user_id36: vote}}, {room: tally deltas})
+        for the votes that were written.
+
+        """
+
+        if not rooms:
+            return {}, {}
+
+        user_id36s = set()
+        for room in rooms:
+            user_id36s.update(votes_by_room[room])
+        old_rows = cls._cf.multiget(
+            [cls._rowkey(room) for room in rooms],
+            columns=list(user_id36s),
+            include_timestamp=True,
+        )
+
+        written_by_room = {}
+        deltas_by_room = {}
+        with cls._cf.batch() as b:
+            for room in rooms:
+                rowkey = cls._rowkey(room)
+                old_votes = old_rows.get(rowkey, {})
+                written = written_by_room[room] = {}
+                deltas = deltas_by_room[room] = defaultdict(int)
+                for user_id36, (vote, timestamp) in (
+                        votes_by_room[room].iteritems()):
+                    if user_id36 not in old_votes:
+                        # the user isn't (or is no longer) in the room
+                        continue
+
+                    old_vote, old_timestamp = old_votes[user_id36]
+                    if old_timestamp >= timestamp:
+                        continue
+
+                    b.insert(rowkey, {user_id36: vote}, timestamp=timestamp)
+                    written[user_id36] = vote
+                    if vote != old_vote:
+                        deltas[vote] += 1
+                        deltas[old_vote] -= 1
+
+        return written_by_room, deltas_by_room
+
+
+class RobinRoomVoteTally(tdb_cassandra.View):
+    """Running count of each vote in a room.
+
+    This is kept up to date as participants join, vote and leave so that the
+    reaper can decide a room's fate without reading every participant's vote.
+    Only rooms with has_vote_tally set have one; older rooms have to be
+    counted from their ParticipantVoteByRoom row.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+    _extra_schema_creation_args = dict(
+        key_validation_class=TIME_UUID_TYPE,
+        default_validation_class=COUNTER_COLUMN_TYPE,
+    )
+
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    @classmethod
+    def _rowkey(cls, room):
+        return room._id
+
+    @classmethod
+    def lock(cls, room):
+        """Lock the room's tally while its votes are read and changed.
+
+        Counter updates aren't idempotent, so every change to a tallied
+        room's ParticipantVoteByRoom row reads the old votes, writes the new
+        ones and applies the difference while holding this.
+
+        """
+
+        return g.make_lock("robin_room", "tally_%s" % room._id)
+
+    @classmethod
+    def update(cls, room, deltas):
+        if not room.has_vote_tally:
+            return
+
         rowkey = cls._rowkey(room)
-        columns = {user._id36: vote}
-        cls._cf.insert(rowkey, columns)
+        for vote, delta in deltas.iteritems():
+            if delta:
+                cls._cf.add(rowkey, vote, delta)
+
+    @classmethod
+    def get_tallies_multi(cls, rooms):
+        """Return a dict of room._id -> {vote: count}.
+
+        Rooms without a tally are left out.
+
+        """
+
+        rooms = [room for room in rooms if room.has_vote_tally]
+        if not rooms:
+            return {}
+
+        rowkeys = [cls._rowkey(room) for room in rooms]
+        rows = cls._cf.multiget(rowkeys)
+        return {rowkey: dict(rows.get(rowkey, {})) for rowkey in rowkeys}
 
 
 class ParticipantPresenceByRoom(tdb_cassandra.View):
@@ -357,6 +1510,11 @@ class ParticipantPresenceByRoom(tdb_cassandra.View):
     _read_consistency_level = tdb_cassandra.CL.QUORUM
     _write_consistency_level = tdb_cassandra.CL.QUORUM
 
+    # presence expires unless it's refreshed by a heartbeat, so users on
+    # websocket nodes that died without sending disconnects eventually drop
+    # out
+    _ttl = int(PRESENCE_TTL.total_seconds())
+
     @classmethod
     def _rowkey(cls, room):
         return room._id
@@ -373,6 +1531,19 @@ class ParticipantPresenceByRoom(tdb_cassandra.View):
         columns = {user._id36: ""}
         cls._cf.remove(rowkey, columns)
 
+    @classmethod
+    def update_presence(cls, room, joined_users, exited_users):
+        """Mark many users as joined or exited with one batch mutation."""
+        rowkey = cls._rowkey(room)
+        with cls._cf.batch() as b:
+            if joined_users:
+                columns = {user._id36: "" for user in joined_users}
+                b.insert(rowkey, columns, ttl=cls._ttl)
+
+            if exited_users:
+                columns = [user._id36 for user in exited_users]
+                b.remove(rowkey, columns)
+
     @classmethod
     def get_present_user_ids(cls, room):
         rowkey = cls._rowkey(room)
@@ -382,6 +1553,20 @@ class ParticipantPresenceByRoom(tdb_cassandra.View):
             return set()
         return {int(id36, 36) for id36 in columns.keys()}
 
+    @classmethod
+    def get_present_user_ids_multi(cls, rooms):
+        """Return a dict of room._id -> set of present user ids."""
+        rowkeys = [cls._rowkey(room) for room in rooms]
+        if not rowkeys:
+            return {}
+
+        rows = cls._cf.multiget(
+            rowkeys, column_count=ParticipantVoteByRoom._max_column_count)
+        return {
+            rowkey: {int(id36, 36) for id36 in rows.get(rowkey, {})}
+            for rowkey in rowkeys
+        }
+
 
 class RoomsByParticipant(tdb_cassandra.View):
     _use_db = True
@@ -423,6 +1608,83 @@ class RoomsByParticipant(tdb_cassandra.View):
         if status != "EXITED":
             return room_id
 
+    @classmethod
+    def get_room_ids_multi(cls, users):
+        """Return a dict of user._id -> current room id."""
+        rowkeys = [cls._rowkey(user) for user in users]
+        if not rowkeys:
+            return {}
+
+        rows = cls._cf.multiget(rowkeys, column_count=1, column_reversed=True)
+        ret = {}
+        for rowkey, columns in rows.iteritems():
+            if not columns:
+                continue
+            room_id, status = columns.items()[0]
+            if status != "EXITED":
+                ret[int(rowkey, 36)] = room_id
+        return ret
+
+
+class RoomAssignmentByParticipant(tdb_cassandra.View):
+    """Each user's current room and whether they're still active in it.
+
+    This is a denormalization of RoomsByParticipant, ParticipantVoteByRoom
+    and RobinRoom.is_alive so that finding a user's room only takes one read.
+    The matchmaker records assignments as users are added to rooms, the
+    reaper marks them dead when rooms are abandoned or moved and the leave
+    path marks them exited.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    ALIVE = "ALIVE"
+    EXITED = "EXITED"
+    DEAD = "DEAD"
+
+    @classmethod
+    def _rowkey(cls, user):
+        return user._id36
+
+    @classmethod
+    def _columns(cls, room, status):
+        return {"room_id": room.id, "status": status}
+
+    @classmethod
+    def set_assignment(cls, user_id36s, room, status):
+        columns = cls._columns(room, status)
+        with cls._cf.batch() as b:
+            for user_id36 in user_id36s:
+                b.insert(user_id36, columns)
+
+    @classmethod
+    def get_assignment(cls, user):
+        """Return a tuple of (room_id, status) or None if there isn't one."""
+        rowkey = cls._rowkey(user)
+        try:
+            columns = cls._cf.get(rowkey)
+        except tdb_cassandra.NotFoundException:
+            return None
+        return columns["room_id"], columns["status"]
+
+    @classmethod
+    def get_assignments(cls, users):
+        """Return a dict of user._id -> (room_id, status)."""
+        rowkeys = [cls._rowkey(user) for user in users]
+        if not rowkeys:
+            return {}
+
+        rows = cls._cf.multiget(rowkeys)
+        return {
+            int(rowkey, 36): (columns["room_id"], columns["status"])
+            for rowkey, columns in rows.iteritems()
+        }
+
 
 def populate(start=0, num_users=16384):
     from r2.models.account import Account, register, AccountExists
@@ -439,7 +1701,11 @@ def populate(start=0, num_users=16384):
 
 
 def clear_all():
-    g.cache.delete("current_robin_room")
+    from reddit_robin.matchmaker import clear_filling_slots
+
+    clear_filling_slots()
     for cls in (RobinRoom, ParticipantVoteByRoom, ParticipantPresenceByRoom,
-                RoomsByParticipant):
+                RoomsByParticipant, RoomsByReapMinute,
+                RoomAssignmentByParticipant, RobinRoomArchive,
+                RobinRoomVoteTally, RoomsAwaitingMerge):
         cls._cf.truncate()
@@ -1,12 +1,12 @@
 from collections import namedtuple
+import time
 
 from pylons import tmpl_context as c
 
 from r2.lib.pages import Reddit
 from r2.lib.wrapped import Templated
-from r2.models import Account
 
-from reddit_robin.models import RobinRoom
+from reddit_robin.models import get_room_summaries
 
 
 class RobinPage(Reddit):
@@ -33,20 +33,33 @@ class RobinJoin(Templated):
     pass
 
 
-RoomDetails = namedtuple("RoomDetails", ["id", "participants", "level"])
+RoomDetails = namedtuple(
+    "RoomDetails", ["id", "level", "num_participants", "age", "votes"])
 
 class RobinAll(Templated):
-    def __init__(self):
-        all_rooms = list(RobinRoom.generate_voting_rooms())
+    def __init__(self, page=1):
+        info, summaries = get_room_summaries(page)
+        self.page = page
         self.rooms = []
-        for room in all_rooms:
-            participant_ids = room.get_all_participants()
-            participants = Account._byID(
-                participant_ids, data=True, return_dict=False)
+
+        if info:
+            # the summaries were built by a job a little while ago
+            updated_ago = max(0, int(time.time() - info["generated"]))
+            self.num_rooms = info["num_rooms"]
+            self.num_pages = info["num_pages"]
+        else:
+            updated_ago = None
+            self.num_rooms = 0
+            self.num_pages = 0
+        self.updated_ago = updated_ago
+
+        for summary in summaries:
             self.rooms.append(RoomDetails(
-                id=room.id,
-                participants=participants,
-                level=room.level,
+                id=summary["id"],
+                level=summary["level"],
+                num_participants=summary["num_participants"],
+                age=summary["age"] + updated_ago,
+                votes=summary["votes"],
             ))
         Templated.__init__(self)
 
@@ -1,5 +1,7 @@
+from collections import defaultdict, OrderedDict
 import json
 import posixpath
+import time
 
 from pylons import app_globals as g
 
@@ -7,49 +9,144 @@ from r2.lib import amqp, websockets
 from r2.lib.db import tdb_cassandra
 from r2.models import Account
 
-from .models import ParticipantPresenceByRoom, RobinRoom
+from .models import ParticipantPresenceByRoom, PRESENCE_TTL, RobinRoom
+
+
+# Presence updates are pulled off the queue in batches and collapsed so that
+# flapping connections only cost one write and one broadcast per room.
+PRESENCE_BATCH_SIZE = 500
+
+# How long to wait for more updates to build up when the queue is empty.
+PRESENCE_BATCH_INTERVAL = 1
+
+# Heartbeats only rewrite a user's presence (refreshing its TTL) if it hasn't
+# been refreshed by this consumer within this many seconds, so frequent
+# heartbeats don't turn into frequent writes.
+HEARTBEAT_REFRESH_INTERVAL = PRESENCE_TTL.total_seconds() / 2
+
+HEARTBEAT_ROUTING_KEY = "robin.heartbeat"
+
+
+def _parse_presence_update(msg):
+    """Return a tuple of (room_id, user_id36, presence_type) or None."""
+    message_type = msg.delivery_info["routing_key"]
+    payload = json.loads(msg.body)
+
+    namespace = payload["namespace"]
+    if not namespace.startswith("/robin/"):
+        return None
+
+    user_id36 = posixpath.basename(namespace)
+    room_namespace = posixpath.dirname(namespace)
+    room_id = posixpath.basename(room_namespace)
+
+    if message_type == HEARTBEAT_ROUTING_KEY:
+        presence_type = "heartbeat"
+    elif message_type == "websocket.connect":
+        presence_type = "join"
+    else:
+        presence_type = "part"
+    return room_id, user_id36, presence_type
+
+
+def queue_heartbeat(room, user):
+    namespace = posixpath.join("/robin", room.id, user._id36)
+    amqp.add_item(HEARTBEAT_ROUTING_KEY, json.dumps({"namespace": namespace}))
+
 
 def run():
+    # (room_id, user_id36) -> when this consumer last refreshed the presence
+    last_refreshed = {}
+    last_pruned = [time.time()]
+
+    def needs_refresh(key, now):
+        last = last_refreshed.get(key)
+        if last and now - last < HEARTBEAT_REFRESH_INTERVAL:
+            return False
+        last_refreshed[key] = now
+        return True
+
     @g.stats.amqp_processor("robin_presence_q")
-    def process_presence_update(msg):
-        message_type = msg.delivery_info["routing_key"]
-        payload = json.loads(msg.body)
+    def process_presence_updates(msgs, chan):
+        now = time.time()
 
-        namespace = payload["namespace"]
-        if not namespace.startswith("/robin/"):
-            return
+        # only the most recent update for each user in each room matters, but
+        # heartbeats never override a real join or part
+        latest_updates = OrderedDict()
+        for msg in msgs:
+            update = _parse_presence_update(msg)
+            if not update:
+                continue
+            room_id, user_id36, presence_type = update
+            key = (room_id, user_id36)
 
-        user_id36 = posixpath.basename(namespace)
-        room_namespace = posixpath.dirname(namespace)
-        room_id = posixpath.basename(room_namespace)
+            if presence_type == "heartbeat":
+                if key in latest_updates or not needs_refresh(key, now):
+                    continue
+            elif presence_type == "join":
+                last_refreshed[key] = now
+            else:
+                last_refreshed.pop(key, None)
+            latest_updates[key] = presence_type
 
-        account = Account._byID36(user_id36, data=True, stale=True)
-        try:
-            room = RobinRoom._byID(room_id)
-        except tdb_cassandra.NotFoundException:
-            return
+        # forget about refreshes that are old enough to be redone anyway
+        if now - last_pruned[0] >= HEARTBEAT_REFRESH_INTERVAL:
+            for key, last in last_refreshed.items():
+                if now - last >= HEARTBEAT_REFRESH_INTERVAL:
+                    del last_refreshed[key]
+            last_pruned[0] = now
 
-        if not room.is_participant(account):
+        if not latest_updates:
             return
 
-        presence_type = "join" if message_type == "websocket.connect" else "part"
+        user_id36s = list({user_id36 for _, user_id36 in latest_updates})
+        accounts_by_id36 = Account._byID36(user_id36s, data=True, stale=True)
+
+        updates_by_room_id = defaultdict(list)
+        for (room_id, user_id36), presence_type in latest_updates.iteritems():
+            account = accounts_by_id36.get(user_id36)
+            if account:
+                updates_by_room_id[room_id].append((account, presence_type))
+
+        for room_id, updates in updates_by_room_id.iteritems():
+            try:
+                room = RobinRoom.get_cached(room_id)
+            except tdb_cassandra.NotFound:
+                continue
+
+            member_ids = set(room.get_member_ids())
+            joined = []
+            parted = []
+            refreshed = []
+            for account, presence_type in updates:
+                if account._id not in member_ids:
+                    continue
 
-        websockets.send_broadcast(
-            namespace=room_namespace,
-            type=presence_type,
-            payload={
-                "user": account.name,
-            },
-        )
+                if presence_type == "join":
+                    joined.append(account)
+                elif presence_type == "part":
+                    parted.append(account)
+                else:
+                    refreshed.append(account)
 
-        if presence_type == "join":
-            ParticipantPresenceByRoom.mark_joined(room, account)
-        else:
-            ParticipantPresenceByRoom.mark_exited(room, account)
+            if joined or parted:
+                websockets.send_broadcast(
+                    namespace="/robin/" + room.id,
+                    type="presence",
+                    payload={
+                        "joined": [account.name for account in joined],
+                        "parted": [account.name for account in parted],
+                    },
+                )
 
+            if joined or parted or refreshed:
+                ParticipantPresenceByRoom.update_presence(
+                    room, joined + refreshed, parted)
 
-    amqp.consume_items(
+    amqp.handle_items(
         "robin_presence_q",
-        process_presence_update,
+        process_presence_updates,
+        limit=PRESENCE_BATCH_SIZE,
+        sleep_time=PRESENCE_BATCH_INTERVAL,
         verbose=True,
     )
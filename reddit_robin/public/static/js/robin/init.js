@@ -7,6 +7,8 @@
   var RobinChat = Backbone.View.extend({
     SYSTEM_USER_NAME: '[robin]',
     MAX_USERS_TO_DISPLAY: 200,
+    // presence expires on the server after 10 minutes without a heartbeat
+    HEARTBEAT_INTERVAL: 3 * 60 * 1000,
 
     lastMessageText: null,
 
@@ -17,10 +19,12 @@
 
       'connected': function() {
         this.addSystemAction('connected!');
+        this.startHeartbeat();
       },
 
       'disconnected': function() {
         this.addSystemAction('disconnected :(');
+        this.stopHeartbeat();
       },
 
       'reconnecting': function(delay) {
@@ -28,11 +32,11 @@
       },
 
       'message:chat': function(message) {
-        if (message.body.indexOf('/me ') === 0) {
-          this.addUserAction(message.from, message.body.slice(4));
-        } else {
-          this.addUserMessage(message.from, message.body);
-        }
+        this.addChatMessage(message);
+      },
+
+      'message:chat_batch': function(message) {
+        (message.messages || []).forEach(this.addChatMessage, this);
       },
 
       'message:system_broadcast': function(message) {
@@ -43,6 +47,12 @@
         this.updateUserVote(message.from, message.vote);
       },
 
+      'message:votes': function(message) {
+        (message.votes || []).forEach(function(vote) {
+          this.updateUserVote(vote.from, vote.vote);
+        }, this);
+      },
+
       'message:join': function(message) {
         this._ensureUser(message.user, { present: true });
       },
@@ -51,6 +61,16 @@
         this._ensureUser(message.user, { present: false });
       },
 
+      'message:presence': function(message) {
+        (message.joined || []).forEach(function(userName) {
+          this._ensureUser(userName, { present: true });
+        }, this);
+
+        (message.parted || []).forEach(function(userName) {
+          this._ensureUser(userName, { present: false });
+        }, this);
+      },
+
       'message:please_vote': function(message) {
         this.addSystemAction('polls are closing soon, please vote');
       },
@@ -497,6 +517,20 @@
       this.websocket.start();
     },
 
+    startHeartbeat: function() {
+      this.stopHeartbeat();
+      this.heartbeatInterval = setInterval(function() {
+        this.room.postHeartbeat();
+      }.bind(this), this.HEARTBEAT_INTERVAL);
+    },
+
+    stopHeartbeat: function() {
+      if (this.heartbeatInterval) {
+        clearInterval(this.heartbeatInterval);
+        this.heartbeatInterval = null;
+      }
+    },
+
     transitionRefresh: function() {
       var timeoutMult = 1;
       if (this.roomParticipants.length > 1000) {
@@ -548,6 +582,14 @@
       return user;
     },
 
+    addChatMessage: function(message) {
+      if (message.body.indexOf('/me ') === 0) {
+        this.addUserAction(message.from, message.body.slice(4));
+      } else {
+        this.addUserMessage(message.from, message.body);
+      }
+    },
+
     addUserMessage: function(userName, messageText) {
       var user = this._ensureUser(userName, { present: true });
       
@@ -1,35 +1,100 @@
 !function(r) {
-  function joinRoom() {
-    r.ajax({
-      type: 'POST',
-      url: '/api/join_room',
+  // the matchmaker pushes a room_assigned message over the websocket, so we
+  // only fall back to polling for the assignment if that never arrives.
+  var ASSIGNMENT_FALLBACK_DELAY = 10000;
+  var ASSIGNMENT_POLL_INTERVAL = 5000;
+  var ASSIGNMENT_POLL_ATTEMPTS = 3;
+  // the join request waits for the websocket to connect so that the push
+  // can't be sent before we're listening, but not for longer than this.
+  var CONNECT_TIMEOUT = 2000;
+
+  var websocket;
+  var websocketConnected = $.Deferred();
+  var pendingJoin;
+
+  function listenForAssignment() {
+    if (!r.config.robin_join_websocket_url) {
+      websocketConnected.resolve();
+      return;
+    }
+
+    if (websocket) {
+      return;
+    }
+
+    websocket = new r.WebSocket(r.config.robin_join_websocket_url);
+    websocket.on({
+      'connected': function() {
+        websocketConnected.resolve();
+      },
+      'message:room_assigned': function(message) {
+        r.log('got roomId: ' + message.room_id);
+        if (pendingJoin) {
+          pendingJoin.resolve(message.room_id);
+        }
+      },
     });
+    websocket.start();
+  }
 
+  function joinRoom() {
     var d = $.Deferred();
+    var posted = false;
+    pendingJoin = d;
+
+    function postJoin() {
+      if (posted) {
+        return;
+      }
+      posted = true;
+
+      r.ajax({
+        type: 'POST',
+        url: '/api/join_room',
+      }).always(function() {
+        // nothing is pushed if we already had a room, so check once
+        checkAssignment(d);
+      });
+    }
 
-    (function waitForAssignment (i) {
+    listenForAssignment();
+    websocketConnected.then(postJoin);
+    setTimeout(postJoin, CONNECT_TIMEOUT);
+
+    (function waitForAssignment (i, delay) {
       setTimeout(function () {
-        var res = getAssignment();
-        if ('roomId' in res.responseJSON) {
-          var roomId = res.responseJSON.roomId;
-          r.log('got roomId: ' + roomId);
-          d.resolve(roomId);
-        } else if (i > 0) {
-          waitForAssignment(i - 1);
-        } else {
-          r.log('ran out of time waiting');
-          d.reject();
+        if (d.state() !== 'pending') {
+          return;
         }
-      }, 1000);
-    })(10);
+
+        checkAssignment(d).always(function(roomId) {
+          if (d.state() !== 'pending') {
+            return;
+          } else if (i > 0) {
+            waitForAssignment(i - 1, ASSIGNMENT_POLL_INTERVAL);
+          } else {
+            r.log('ran out of time waiting');
+            d.reject();
+          }
+        });
+      }, delay);
+    })(ASSIGNMENT_POLL_ATTEMPTS, ASSIGNMENT_FALLBACK_DELAY);
 
     return d.promise();
   }
 
+  function checkAssignment(d) {
+    return getAssignment().then(function(res) {
+      if (d.state() === 'pending' && res && 'roomId' in res) {
+        r.log('got roomId: ' + res.roomId);
+        d.resolve(res.roomId);
+      }
+    });
+  }
+
   function getAssignment() {
     return r.ajax({
       type: 'GET',
-      async: false,
       url: '/api/room_assignment.json',
       dataType: 'json',
     });
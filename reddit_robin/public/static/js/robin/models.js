@@ -176,6 +176,10 @@
       this._post('leave_room');
     },
 
+    postHeartbeat: function() {
+      this._post('heartbeat');
+    },
+
     _getPostData: function(models) {
       var models = [this].concat(models);
       var jsonBlobs = models.map(function(m) { return m.toJSON() });
@@ -1,19 +1,30 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import time
 
 from pylons import app_globals as g
+from pylons import tmpl_context as c
+from pylons.util import ContextObj
 
 from r2.lib import amqp, websockets
+from r2.lib.utils import in_chunks
 from r2.models import Account
 from .models import (
     NOVOTE,
     INCREASE,
     CONTINUE,
     ABANDON,
-    move_dead_rooms,
+    DEFAULT_LEVEL_TIME,
+    get_reap_time,
+    LEVEL_TIMINGS,
     RobinRoom,
+    RoomsAwaitingMerge,
+    RoomsByReapMinute,
+    set_room_summaries,
 )
 from .subreddit_maker import queue_subreddit_creation
+from .votes import flush_votes
 
 
 # We do this on a 2 minute interval, since reaping and vote alerting is done
@@ -22,16 +33,9 @@ from .subreddit_maker import queue_subreddit_creation
 # is bigger than a minute.
 VOTING_PROMPT_TIME = timedelta(minutes=2)
 
-# How long each room will last at each level before merging happens.
-DEFAULT_LEVEL_TIME = timedelta(minutes=32)
-LEVEL_TIMINGS = defaultdict(lambda: DEFAULT_LEVEL_TIME)
-LEVEL_TIMINGS.update({
-    0: timedelta(minutes=2),
-    1: timedelta(minutes=4),
-    2: timedelta(minutes=8),
-    3: timedelta(minutes=16),
-    # >=4: timedelta(minutes=DEFAULT_LEVEL_TIME),
-})
+# Ripe rooms are reaped in chunks of this size so that their votes and
+# participant accounts can be fetched with one bulk read per chunk.
+REAP_CHUNK_SIZE = 100
 
 
 def _prompt_for_voting():
@@ -40,7 +44,7 @@ def _prompt_for_voting():
         now, VOTING_PROMPT_TIME)
 
     count = 0
-    for room in RobinRoom.generate_voting_rooms():
+    for room in RobinRoom.generate_due_rooms(now + VOTING_PROMPT_TIME):
 
         # Skip if we've already prompted
         if room.has_prompted():
@@ -71,10 +75,6 @@ def prompt_for_voting():
     amqp.worker.join()
 
 
-def get_reap_time(room):
-    return room.date + LEVEL_TIMINGS[room.level]
-
-
 def _reap_ripe_rooms():
     """Apply voting decision to each room.
 
@@ -88,55 +88,284 @@ def _reap_ripe_rooms():
     In case of ties precedence is abandon > continue > increase
 
     """
+    # votes are written behind, so make sure everything cast so far has
+    # landed before counting them
+    flush_votes()
+
     now = datetime.now(g.tz)
 
-    to_merge_by_level = {}
-    count = 0
-    for room in RobinRoom.generate_voting_rooms():
+    # rooms still waiting for a merge partner from earlier ticks are
+    # re-decided along with the newly ripe ones
+    ripe_rooms_by_level = defaultdict(list)
+    queued_at_by_level = defaultdict(dict)
+    for room, queued_at in RobinRoom.generate_queued_rooms():
+        ripe_rooms_by_level[room.level].append(room)
+        queued_at_by_level[room.level][room._id] = queued_at
 
+    for room in RobinRoom.generate_due_rooms(now):
         # The room isn't old enough to be merged yet
         if now < get_reap_time(room):
             continue
 
-        print "%s: attempting to merge room %s with age %s" % (
-            datetime.now(g.tz), room, now - room.date)
+        # queued rooms stay in the index until their bucket expires
+        if room._id in queued_at_by_level[room.level]:
+            continue
+        ripe_rooms_by_level[room.level].append(room)
+
+    # merges only pair rooms of the same level, so each level can be reaped
+    # independently
+    jobs = [
+        (now, rooms, queued_at_by_level[level])
+        for level, rooms in ripe_rooms_by_level.iteritems()
+    ]
+    num_workers = g.live_config.get("robin_reaper_workers", 1)
+    if num_workers > 1 and len(jobs) > 1:
+        _map_in_threads(_reap_level, jobs, num_workers)
+    else:
+        for job in jobs:
+            _reap_level(*job)
+
+    count = sum(len(rooms) for rooms in ripe_rooms_by_level.itervalues())
+    print "%s: done reaping (%s rooms took %s)" % (datetime.now(g.tz), count, datetime.now(g.tz) - now)
 
-        count += 1
 
-        # Calculate votes
-        votes_by_user = room.get_all_votes()
-        votes = votes_by_user.values()
-        abandoning_user_ids = {
-            _id for _id, vote in votes_by_user.iteritems()
-            if vote == ABANDON or vote == NOVOTE
-        }
-        num_increase = sum(1 for vote in votes if vote == INCREASE)
-        num_continue = sum(1 for vote in votes if vote == CONTINUE)
-        num_abandon = len(abandoning_user_ids)
-
-        if num_abandon >= num_continue and num_abandon >= num_increase:
-            abandon_room(room)
+def _update_room_summaries():
+    """Cache a summary of every voting room for the admin overview.
+
+    This looks at every voting room, so it runs as its own job every few
+    minutes rather than as part of the reaper.
+
+    """
+
+    now = datetime.now(g.tz)
+
+    # voting rooms are indexed by their reap time, which is never further
+    # away than the longest level timing
+    longest_level_time = max(LEVEL_TIMINGS.values() + [DEFAULT_LEVEL_TIME])
+    rooms = list(RobinRoom.generate_due_rooms(now + longest_level_time))
+    room_ids = {room._id for room in rooms}
+    rooms.extend(
+        room for room, queued_at in RobinRoom.generate_queued_rooms()
+        if room._id not in room_ids
+    )
+
+    summaries = []
+    for chunk in in_chunks(rooms, REAP_CHUNK_SIZE):
+        tallies_by_room_id = RobinRoom.get_vote_tallies_multi(chunk)
+        untallied = [room for room in chunk
+                     if room._id not in tallies_by_room_id]
+        votes_by_room_id = RobinRoom.get_all_votes_multi(untallied)
+        for room_id, votes_by_user in votes_by_room_id.iteritems():
+            tallies_by_room_id[room_id] = Counter(votes_by_user.itervalues())
+
+        for room in chunk:
+            tally = tallies_by_room_id.get(room._id, {})
+            summaries.append({
+                "id": room.id,
+                "level": room.level,
+                "num_participants": sum(tally.values()),
+                "age": int((now - room.date).total_seconds()),
+                "votes": {vote: count for vote, count in tally.iteritems()
+                          if count},
+            })
+
+    summaries.sort(
+        key=lambda summary: (summary["level"], summary["num_participants"]),
+        reverse=True,
+    )
+    set_room_summaries(summaries)
+
+
+def _reap_level(now, rooms, queued_at):
+    """Apply voting decisions to ripe rooms that all have the same level.
+
+    queued_at is a dict of room._id -> when the room was put in the merge
+    queue, for the rooms that are waiting there.
+
+    """
+
+    to_merge = []
+    for chunk in in_chunks(rooms, REAP_CHUNK_SIZE):
+        # decide as many rooms as possible from their running tallies. the
+        # full vote row is only needed to find out who is abandoning, to move
+        # everyone in a merge, or for rooms that don't have a tally
+        tallies_by_room_id = RobinRoom.get_vote_tallies_multi(chunk)
+        decisions = {}
+        needs_votes = []
+        for room in chunk:
+            tally = tallies_by_room_id.get(room._id)
+            if tally is None:
+                needs_votes.append(room)
+                continue
+
+            decision = _decide(tally)
+            decisions[room._id] = decision
+            if decision != CONTINUE or _count_abandoning(tally):
+                needs_votes.append(room)
+
+        votes_by_room_id = RobinRoom.get_all_votes_multi(needs_votes)
+        user_ids = set()
+        for room in needs_votes:
+            # counter updates aren't idempotent, so once the row has been
+            # read it's the row that decides the room, not the tally
+            votes_by_user = votes_by_room_id.setdefault(room._id, {})
+            tally = Counter(votes_by_user.itervalues())
+            if room._id in tallies_by_room_id and not _tallies_match(
+                    tallies_by_room_id[room._id], tally):
+                g.stats.simple_event('robin.reaper.tally_mismatch')
+                print "%s: vote tally %s doesn't match votes %s" % (
+                    room, dict(tallies_by_room_id[room._id]), dict(tally))
+            tallies_by_room_id[room._id] = tally
+            decisions[room._id] = _decide(tally)
+
+            # abandoned rooms only need participant ids, not accounts
+            if decisions[room._id] != ABANDON:
+                user_ids.update(votes_by_user.iterkeys())
+
+        if user_ids:
+            accounts_by_id = Account._byID(
+                user_ids, data=True, return_dict=True)
         else:
+            accounts_by_id = {}
+
+        for room in chunk:
+            print "%s: attempting to merge room %s with age %s" % (
+                datetime.now(g.tz), room, now - room.date)
+
+            decision = decisions[room._id]
+            votes_by_user = votes_by_room_id.get(room._id)
+
+            if decision == ABANDON:
+                abandon_room(room, votes_by_user.keys())
+                continue
+
+            if votes_by_user is None:
+                # nobody is abandoning, so everyone in the tally stays
+                num_participants = sum(tallies_by_room_id[room._id].values())
+                continue_room(room, num_participants)
+                continue
+
             # no matter the vote outcome, abandoning users are removed
+            abandoning_user_ids = {
+                _id for _id, vote in votes_by_user.iteritems()
+                if vote not in (INCREASE, CONTINUE)
+            }
             if abandoning_user_ids:
-                abandoning_users = Account._byID(
-                    abandoning_user_ids, data=True, return_dict=False)
+                abandoning_users = [
+                    accounts_by_id[_id] for _id in abandoning_user_ids
+                    if _id in accounts_by_id
+                ]
                 remove_abandoners(room, abandoning_users)
 
-            if num_continue >= num_increase:
-                continue_room(room)
+            participants = [
+                accounts_by_id[_id] for _id in votes_by_user
+                if _id in accounts_by_id and _id not in abandoning_user_ids
+            ]
+
+            if decision == CONTINUE:
+                continue_room(room, len(participants))
             else:
-                if room.level in to_merge_by_level:
-                    other_room = to_merge_by_level.pop(room.level)
-                    merge_rooms(room, other_room)
-                else:
-                    to_merge_by_level[room.level] = room
-
-    for level, orphaned_room in to_merge_by_level.iteritems():
-        alert_no_match(orphaned_room)
-    print "%s: done reaping (%s rooms took %s)" % (datetime.now(g.tz), count, datetime.now(g.tz) - now)
+                to_merge.append((room, participants))
+
+    unmatched = _merge_by_size(to_merge, queued_at)
+
+    # rooms stay in the merge queue only as long as they keep voting to
+    # increase without finding a partner
+    for room in rooms:
+        if room._id in queued_at and room is not unmatched:
+            RoomsAwaitingMerge.remove_room(room)
+
+    if unmatched and unmatched._id not in queued_at:
+        alert_no_match(unmatched)
+
 
-    move_dead_rooms()
+def _merge_by_size(to_merge, queued_at):
+    """Pair up and merge rooms that voted to increase.
+
+    to_merge is a list of (room, participants) tuples. If there's an odd
+    number of rooms the one that's been waiting the least is left out, and
+    the rest are paired with the rooms closest to them in size. Returns the
+    room that was left out, if any.
+
+    """
+
+    now = time.time()
+    to_merge.sort(
+        key=lambda (room, participants): queued_at.get(room._id, now))
+
+    unmatched = None
+    if len(to_merge) % 2:
+        unmatched, _ = to_merge.pop()
+
+    to_merge.sort(key=lambda (room, participants): len(participants))
+    groups = [
+        ((room1, room2), participants1 + participants2)
+        for (room1, participants1), (room2, participants2) in zip(
+            to_merge[::2], to_merge[1::2])
+    ]
+    if groups:
+        merge_many_rooms(groups)
+
+    return unmatched
+
+
+def _map_in_threads(fn, jobs, num_workers):
+    """Call fn(*job) for each job using a pool of threads.
+
+    The pylons globals are registered per-thread, so each worker needs the
+    current app_globals pushed before it can do anything useful, and a
+    tmpl_context of its own for the db layer to keep its state on.
+
+    """
+
+    app_globals = g._current_obj()
+
+    def run_job(job):
+        tmpl_context = ContextObj()
+        tmpl_context.use_write_db = {}
+        g._push_object(app_globals)
+        c._push_object(tmpl_context)
+        try:
+            return fn(*job)
+        finally:
+            c._pop_object(tmpl_context)
+            g._pop_object(app_globals)
+
+    pool = ThreadPool(num_workers)
+    try:
+        return pool.map(run_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _tallies_match(tally1, tally2):
+    votes = set(tally1) | set(tally2)
+    return all(tally1.get(vote, 0) == tally2.get(vote, 0) for vote in votes)
+
+
+def _count_abandoning(tally):
+    # no vote counts as a vote to abandon
+    return tally.get(ABANDON, 0) + tally.get(NOVOTE, 0)
+
+
+def _decide(tally):
+    """Return the winning vote given a room's tally of {vote: count}.
+
+    In case of ties precedence is abandon > continue > increase.
+
+    """
+
+    num_increase = tally.get(INCREASE, 0)
+    num_continue = tally.get(CONTINUE, 0)
+    num_abandon = _count_abandoning(tally)
+
+    if num_abandon >= num_continue and num_abandon >= num_increase:
+        return ABANDON
+    elif num_continue >= num_increase:
+        return CONTINUE
+    else:
+        return INCREASE
 
 
 def reap_ripe_rooms():
@@ -146,6 +375,12 @@ def reap_ripe_rooms():
     amqp.worker.join()
 
 
+def update_room_summaries():
+    with g.stats.get_timer('robin.update_room_summaries'):
+        _update_room_summaries()
+    g.stats.flush()
+
+
 def remove_abandoners(room, users):
     print "removing %s from %s" % (users, room)
     room.remove_participants(users)
@@ -159,18 +394,18 @@ def remove_abandoners(room, users):
     )
 
 
-def continue_room(room):
+def continue_room(room, num_participants):
     print "continuing %s" % room
     room.continu()
-    if len(room.get_all_participants()) > 1:
+    if num_participants > 1:
         queue_subreddit_creation(room)
 
     g.stats.simple_event('robin.reaper.continue')
 
 
-def abandon_room(room):
+def abandon_room(room, participant_ids=None):
     print "abandoning %s" % room
-    room.abandon()
+    room.abandon(participant_ids)
 
     websockets.send_broadcast(
         namespace="/robin/" + room.id,
@@ -181,25 +416,33 @@ def abandon_room(room):
     g.stats.simple_event('robin.reaper.abandon')
 
 
-def merge_rooms(room1, room2):
-    print "merging %s + %s" % (room1, room2)
-    new_room = RobinRoom.merge(room1, room2)
+def merge_many_rooms(groups):
+    """Merge each (rooms, participants) group with one bulk write."""
+    for rooms, participants in groups:
+        print "merging %s" % " + ".join(str(room) for room in rooms)
+    new_rooms = RobinRoom.merge_many(groups)
 
-    for room in (room1, room2):
-        websockets.send_broadcast(
-            namespace="/robin/" + room.id,
-            type="merge",
-            payload={
-                "destination": new_room.id,
-            },
-        )
+    for (rooms, participants), new_room in zip(groups, new_rooms):
+        for room in rooms:
+            websockets.send_broadcast(
+                namespace="/robin/" + room.id,
+                type="merge",
+                payload={
+                    "destination": new_room.id,
+                },
+            )
 
-    g.stats.simple_event('robin.reaper.merge')
+    g.stats.simple_event('robin.reaper.merge', delta=len(groups))
 
 
 def alert_no_match(room):
     print "no match for %s" % room
 
+    # the room waits in the merge queue, which is checked on every tick,
+    # rather than in the reap index
+    RoomsAwaitingMerge.add_room(room, time.time())
+    RoomsByReapMinute.remove_room(room, get_reap_time(room))
+
     websockets.send_broadcast(
         namespace="/robin/" + room.id,
         type="no_match",
@@ -1,11 +1,23 @@
+import json
+
 from pylons import app_globals as g
 
 from r2.lib import amqp, websockets
 from r2.lib.db import tdb_cassandra
-from r2.models import Account
+from r2.lib.utils import in_chunks
+from r2.models import Account, Subreddit
 from r2.models.admintools import send_system_message
+from r2.models.subreddit import SRMember
+
+from .models import RobinRoom, RobinRoomArchive, RobinRoomDead
+
 
-from .models import RobinRoom, RobinRoomDead
+NUM_MODERATORS = 5
+
+# Contributors are added and messaged by the robin_subreddit_members_q
+# consumers in chunks of this many participants, so creating a subreddit for
+# a huge room doesn't tie up the subreddit maker.
+MEMBERS_CHUNK_SIZE = 100
 
 
 def send_sr_message(subreddit, recipient):
@@ -26,9 +38,13 @@ def run_subreddit_maker():
             room = RobinRoom._byID(room_id)
         except tdb_cassandra.NotFound:
             try:
-                room = RobinRoomDead._byID(room_id)
+                room = RobinRoomArchive.get(room_id)
             except tdb_cassandra.NotFound:
-                print "can't find room %s, giving up" % room_id
+                try:
+                    room = RobinRoomDead._byID(room_id)
+                except tdb_cassandra.NotFound:
+                    print "can't find room %s, giving up" % room_id
+                    return
         print 'creating sr for room %s' % room
 
         subreddit = room.create_sr()
@@ -36,26 +52,19 @@ def run_subreddit_maker():
 
         if subreddit:
             g.stats.simple_event("robin.subreddit.created")
-            participant_ids = room.get_all_participants()
-            participants = [
-                Account._byID(participant_id)
-                for participant_id in participant_ids
-            ]
-            moderators = participants[:5]
+            participant_ids = sorted(room.get_all_participants())
+
+            moderator_ids = participant_ids[:NUM_MODERATORS]
+            moderators = Account._byID(
+                moderator_ids, data=True, return_dict=False)
 
             print 'adding moderators to %s' % subreddit
             for moderator in moderators:
                 subreddit.add_moderator(moderator)
 
-            print 'adding contributors to %s' % subreddit
-            g.stats.simple_event(
-                "robin.subreddit.contributors_added",
-                delta=len(participants),
-            )
-            for participant in participants:
-                # To be replaced with UserRel hacking?
-                subreddit.add_contributor(participant)
-                send_sr_message(subreddit, participant)
+            print 'queueing contributors for %s' % subreddit
+            for chunk in in_chunks(participant_ids, MEMBERS_CHUNK_SIZE):
+                queue_subreddit_members(subreddit, chunk)
 
             payload = {
                 "body": subreddit.name,
@@ -73,5 +82,43 @@ def run_subreddit_maker():
     amqp.consume_items('robin_subreddit_maker_q', process_subreddit_maker)
 
 
+def run_subreddit_members():
+    @g.stats.amqp_processor('robin_subreddit_members_q')
+    def process_subreddit_members(msg):
+        payload = json.loads(msg.body)
+        subreddit = Subreddit._byID(payload["subreddit_id"], data=True)
+        participants = Account._byID(
+            payload["participant_ids"], data=True, return_dict=False)
+
+        # skip anyone that was already added in case this chunk is redelivered
+        existing = SRMember._fast_query(
+            subreddit, participants, "contributor", data=False)
+        new_participants = [
+            participant for participant in participants
+            if not existing[(subreddit, participant, "contributor")]
+        ]
+
+        print 'adding %s contributors to %s' % (
+            len(new_participants), subreddit)
+        g.stats.simple_event(
+            "robin.subreddit.contributors_added",
+            delta=len(new_participants),
+        )
+        for participant in new_participants:
+            # To be replaced with UserRel hacking?
+            subreddit.add_contributor(participant)
+            send_sr_message(subreddit, participant)
+
+    amqp.consume_items('robin_subreddit_members_q', process_subreddit_members)
+
+
 def queue_subreddit_creation(room):
     amqp.add_item('robin_subreddit_maker_q', room.id)
+
+
+def queue_subreddit_members(subreddit, participant_ids):
+    payload = {
+        "subreddit_id": subreddit._id,
+        "participant_ids": list(participant_ids),
+    }
+    amqp.add_item('robin_subreddit_members_q', json.dumps(payload))
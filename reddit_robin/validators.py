@@ -14,7 +14,7 @@ class VRobinRoom(Validator):
 
     def run(self, id):
         try:
-            room = RobinRoom._byID(id)
+            room = RobinRoom.get_cached(id)
         except tdb_cassandra.NotFound:
             abort(404)
 
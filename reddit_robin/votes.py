@@ -0,0 +1,178 @@
+from collections import defaultdict, OrderedDict
+import json
+import os
+import socket
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import amqp, websockets
+from r2.lib.db import tdb_cassandra
+from r2.models import Account
+
+from .models import ParticipantVoteByRoom, RobinRoom
+
+
+# Votes are written behind: the vote endpoint just queues them and they're
+# pulled off the queue in batches so that the burst after the please_vote
+# broadcast costs one write and one broadcast per room.
+VOTE_BATCH_SIZE = 500
+
+# How long to wait for more votes to build up when the queue is empty. This
+# bounds how long a vote can sit in the queue before it's written.
+VOTE_BATCH_INTERVAL = 1
+
+# Each consumer marks the batch it's writing with a key of its own, so the
+# reaper can wait for them after draining the queue itself. The consumers are
+# listed in VOTE_CONSUMERS_KEY so that their keys can be found.
+VOTES_IN_FLIGHT_KEY_PREFIX = "robin:votes_in_flight:"
+VOTES_IN_FLIGHT_TTL = 60
+VOTE_CONSUMERS_KEY = "robin:vote_consumers"
+
+# Consumers re-register this often so that ones that have died can be
+# dropped from the list.
+VOTE_CONSUMER_REGISTER_INTERVAL = 60 * 60
+
+# The longest the reaper will wait for consumers to finish their batches.
+VOTE_FLUSH_TIMEOUT = 10
+
+
+def queue_vote(room, user, vote):
+    payload = {
+        "room_id": room.id,
+        "user_id36": user._id36,
+        "vote": vote,
+        # the vote is written with the time it was cast so that if it's
+        # written out of order with a later vote the later one still wins
+        "cast_at": int(time.time() * 1e6),
+    }
+    amqp.add_item("robin_vote_q", json.dumps(payload))
+
+
+def _in_flight_key():
+    return "%s%s:%s" % (
+        VOTES_IN_FLIGHT_KEY_PREFIX, socket.gethostname(), os.getpid())
+
+
+def _register_consumer(key):
+    """Make sure this consumer's key is in the list the reaper checks."""
+
+    now = time.time()
+    consumers = g.cache.get(VOTE_CONSUMERS_KEY, allow_local=False) or {}
+    if consumers.get(key, 0) > now - VOTE_CONSUMER_REGISTER_INTERVAL:
+        return
+
+    with g.make_lock("robin_votes", "consumers"):
+        consumers = g.cache.get(VOTE_CONSUMERS_KEY, allow_local=False) or {}
+        cutoff = now - 2 * VOTE_CONSUMER_REGISTER_INTERVAL
+        consumers = {
+            consumer_key: registered_at
+            for consumer_key, registered_at in consumers.iteritems()
+            if registered_at > cutoff
+        }
+        consumers[key] = now
+        g.cache.set(VOTE_CONSUMERS_KEY, consumers)
+
+
+def _process_votes(msgs, chan):
+    key = _in_flight_key()
+    _register_consumer(key)
+    g.cache.set(key, len(msgs), time=VOTES_IN_FLIGHT_TTL)
+    try:
+        _write_votes(msgs)
+    finally:
+        g.cache.delete(key)
+
+
+def _write_votes(msgs):
+    # only the most recent vote from each user in each room matters
+    latest_votes = OrderedDict()
+    for msg in msgs:
+        payload = json.loads(msg.body)
+        key = (payload["room_id"], payload["user_id36"])
+        cast_at = payload.get("cast_at") or int(time.time() * 1e6)
+        vote = (payload["vote"], cast_at)
+        if key not in latest_votes or latest_votes[key][1] < vote[1]:
+            latest_votes[key] = vote
+
+    if not latest_votes:
+        return
+
+    votes_by_room_id = defaultdict(OrderedDict)
+    for (room_id, user_id36), vote in latest_votes.iteritems():
+        votes_by_room_id[room_id][user_id36] = vote
+
+    votes_by_room = {}
+    for room_id, votes in votes_by_room_id.iteritems():
+        try:
+            room = RobinRoom.get_cached(room_id)
+        except tdb_cassandra.NotFound:
+            print "dropping votes for missing room %s" % room_id
+            continue
+
+        # users that left or were removed since voting mustn't be put back
+        member_ids = set(room.get_member_ids())
+        votes_by_room[room] = OrderedDict(
+            (user_id36, vote) for user_id36, vote in votes.iteritems()
+            if int(user_id36, 36) in member_ids
+        )
+
+    written_by_room = ParticipantVoteByRoom.set_votes_multi(votes_by_room)
+
+    user_id36s = list({user_id36 for _, user_id36 in latest_votes})
+    accounts_by_id36 = Account._byID36(user_id36s, data=True, stale=True)
+
+    for room, written in written_by_room.iteritems():
+        if not written:
+            continue
+
+        votes = [
+            {"from": accounts_by_id36[user_id36].name, "vote": vote}
+            for user_id36, vote in written.iteritems()
+            if user_id36 in accounts_by_id36
+        ]
+        websockets.send_broadcast(
+            namespace="/robin/" + room.id,
+            type="votes",
+            payload={"votes": votes},
+        )
+
+
+def flush_votes():
+    """Write every vote that's been queued so far.
+
+    The reaper calls this before counting votes so that no vote cast before
+    it started is missed. It drains the queue itself and then waits for the
+    consumers to finish writing any batches they'd already taken.
+
+    """
+
+    amqp.handle_items(
+        "robin_vote_q",
+        g.stats.amqp_processor("robin_vote_q")(_process_votes),
+        limit=VOTE_BATCH_SIZE,
+        drain=True,
+        verbose=False,
+    )
+
+    consumers = g.cache.get(VOTE_CONSUMERS_KEY, allow_local=False) or {}
+    if not consumers:
+        return
+
+    give_up_at = time.time() + VOTE_FLUSH_TIMEOUT
+    while g.cache.get_multi(consumers.keys(), allow_local=False):
+        if time.time() > give_up_at:
+            g.stats.simple_event("robin.vote.flush_timeout")
+            print "gave up waiting for vote consumers"
+            break
+        time.sleep(0.1)
+
+
+def run():
+    amqp.handle_items(
+        "robin_vote_q",
+        g.stats.amqp_processor("robin_vote_q")(_process_votes),
+        limit=VOTE_BATCH_SIZE,
+        sleep_time=VOTE_BATCH_INTERVAL,
+        verbose=True,
+    )